@@ -1,12 +1,55 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from bot import graph,chat,get_current_datetime_response
+from bot import build_graph,get_current_datetime_response
+from hospital_cache import hospital_cache
+from embedding_cache import query_embeddings, retrieved_documents
+import doctor_lookup
 from langchain_core.messages import HumanMessage
+from checkpointer import mongo_saver
+import resources
+import tool_registry
+from scheduler import scheduler, overloaded
+from turns import turns, error_event
+from router import route_stats
+from slots import inventory
+import metrics
+import cassette
+from contextlib import asynccontextmanager
 import asyncio
+import os
+import sys
+import time
 
-app = FastAPI()
+graph = None
+checkpointer = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global graph
+    global checkpointer
+    resources.open_resources()
+    # heavy tool dependencies load in the background, the first request does not wait for them
+    preload = asyncio.create_task(asyncio.to_thread(tool_registry.preload))
+    # the checkpointer shares the process wide motor client (and its pool) with the tools
+    async with mongo_saver.open(db_name=os.environ["DBNAME"], client=resources.motor()) as checkpointer:
+        metrics.instrument_checkpointer(checkpointer)
+        graph = metrics.instrument_graph(build_graph(checkpointer))
+        if cassette.CASSETTE_DIR:
+            graph = cassette.record(graph)
+        compaction = asyncio.create_task(checkpointer.run_compaction())
+        flusher = asyncio.create_task(checkpointer.run_flusher())
+        yield
+        await turns.shutdown()
+        compaction.cancel()
+        flusher.cancel()
+        await checkpointer.flush()
+    await preload
+    await resources.close_resources()
+    doctor_lookup.close()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
@@ -22,57 +65,122 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-static_sys = """You are a healthcare assistant deployed on a website named "MediMitra".
-Your role is:
-1. Assist the users with there health related issues, for this you can also access a database to get some information
-   on diseases to help the user properly.
-2. Talk to the user like a professional but in a soft and cheering tone since the user is ill and he needs support.
-3. If the user wants you have to book the user's appointment with the doctor.
-4. "You must call only one tool at a time"
-
-While booking user's appointment with a doctor follow this type of thinking:
-User input: Tell me about the doctors available in my area.
-Assistant: Calls a tool like api_retriver to get the Hospitals.
-Tool: Hospitals list near the user.
-Assistant: Calls a tool to get the doctors from the hospitals.
-Tools: Gives the doctors available
-Assistant: Tell the user about the doctors and there time slots and asks the user for which doctor to book and confirm
-about booking.
-User: Says to book some of the doctors
-Assistant: Calls a tool to book appointment of the doctor.
-
-If you want to know about some type of disease or symptom related data use the disease info tool and also web search
-
-"""
+metrics.gauge_from("agent_scheduler_queued", "model calls waiting for the scheduler", lambda: len(scheduler.waiting))
+metrics.gauge_from("agent_scheduler_running", "model calls in flight", lambda: scheduler.running)
+metrics.gauge_from("agent_mongo_connections_in_use", "checked out mongo connections", lambda: resources.mongo_pool.in_use)
+
 dynamic_sys= f"{get_current_datetime_response()}, Location of the user= lat=16.27939453125&lon=80.58837890625 \n"
 
 
-def stream_chat(message,id):
+def overloaded_event(error: overloaded) -> str:
+    return error_event("overloaded", str(error), retry_after=round(error.retry_after, 1))
+
+
+async def stream_chat(message,id):
     input_ = message
     id_ = id
     
-    global static_sys
     global dynamic_sys
     dynamic = dynamic_sys + " User id: " + id_
-    state = chat(static_system=static_sys,
-                 dynamic_system=dynamic,
-                 summary="",
-                 messages=[HumanMessage(input_)])
-    for chunk, meta in graph.stream(input=state,
-                                config={"configurable": {"thread_id": id_}},
-                                stream_mode="messages"
-                                ):
-        if chunk.content and meta["langgraph_node"] == "chat_node":
-            yield f"data: {chunk.content}\n\n"
+    # only the conversation goes into the checkpoint, the system prompts are
+    # resolved per run: the static one by version id, the dynamic one from the config
+    state = {"messages": [HumanMessage(input_)]}
+    if scheduler.saturated():
+        # admission control: refuse before anything is checkpointed
+        metrics.STREAM_ERRORS.labels("overloaded").inc()
+        yield overloaded_event(overloaded("the assistant is busy", retry_after=scheduler.max_wait))
+        return
+    started = time.perf_counter()
+    first_token = True
+    metrics.ACTIVE_STREAMS.inc()
+    try:
+        async for chunk, meta in graph.astream(input=state,
+                                    config={"configurable": {"thread_id": id_, "dynamic_system": dynamic}},
+                                    stream_mode="messages"
+                                    ):
+            if chunk.content and meta["langgraph_node"] == "chat_node":
+                if first_token:
+                    metrics.FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                    first_token = False
+                yield f"data: {chunk.content}\n\n"
+    except overloaded as e:
+        metrics.STREAM_ERRORS.labels("overloaded").inc()
+        yield overloaded_event(e)
+    except Exception as e:
+        metrics.STREAM_ERRORS.labels(type(e).__name__).inc()
+        raise
+    finally:
+        metrics.ACTIVE_STREAMS.dec()
+        metrics.TURN_SECONDS.observe(time.perf_counter() - started)
+        # turn end: the checkpoints of this turn go to mongo in one bulk write
+        await checkpointer.flush(id_)
 
 class request_(BaseModel):
     message: str
     id: str
+    # a client retrying the same message sends the same key and gets the same turn
+    idempotency_key: str | None = None
     
 @app.post("/chat_message")
-def stream(request: request_):
+async def stream(request: request_):
     message = request.message
     id = request.id
     
-    return StreamingResponse(stream_chat(message,id),media_type="text/event-stream")
-    
\ No newline at end of file
+    # the turn runs on its own, this response only follows its events
+    turn = turns.submit(id, message, request.idempotency_key, lambda: stream_chat(message,id))
+    if turn is None:
+        metrics.STREAM_ERRORS.labels("busy").inc()
+        return StreamingResponse(iter([error_event("busy", "a reply for this chat is still being written")]),
+                                 status_code=409, media_type="text/event-stream")
+    return StreamingResponse(turn.follow(),media_type="text/event-stream")
+
+@app.get("/chat_message/{id}/stream")
+async def reattach(id: str, offset: int = 0):
+    """follow the running (or last) turn of a chat again, e.g. after a dropped connection,
+    from the `offset`-th event on"""
+    turn = turns.latest(id)
+    if turn is None:
+        raise HTTPException(status_code=404, detail="no turn to follow for this chat")
+    return StreamingResponse(turn.follow(offset),media_type="text/event-stream")
+
+@app.get("/cache_stats")
+async def cache_stats():
+    return {"hospitals": hospital_cache.stats(),
+            "query_embeddings": query_embeddings.stats(),
+            "retrieved_documents": retrieved_documents.stats(),
+            "tools": tool_registry.stats(),
+            "doctors": doctor_lookup.doctor_cache.stats(),
+            # web_search is a lazy tool, it has no stats before its first call
+            "web_search": sys.modules["web_search"].search_stats() if "web_search" in sys.modules else None}
+
+@app.get("/checkpoint_stats")
+async def checkpoint_stats():
+    return {"compaction": checkpointer.report,
+            "cache": checkpointer.cache.stats() if checkpointer.cache else None,
+            "write_behind": dict(checkpointer.flushes, enabled=checkpointer.write_behind,
+                                 buffered_threads=len(checkpointer.buffered))}
+
+@app.get("/pool_stats")
+async def pool_stats():
+    return resources.stats()
+
+@app.get("/scheduler_stats")
+async def scheduler_stats():
+    return scheduler.report()
+
+@app.get("/turn_stats")
+async def turn_stats():
+    return turns.report()
+
+@app.get("/route_stats")
+async def route_stats_():
+    return route_stats.report()
+
+@app.get("/metrics")
+async def metrics_():
+    body, content_type = metrics.latest()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/slot_stats")
+async def slot_stats():
+    return inventory.report()
@@ -0,0 +1,66 @@
+# %%
+"""Bytes the checkpointer writes per turn.
+
+Plays a scripted conversation (one tool call per turn) through the real graph with a
+fake model, and counts what a MongoDB saver would store: the serialized checkpoint of
+every put plus the serialized value of every pending write.
+
+    python bench_checkpoint_size.py --turns 10
+"""
+import argparse
+import asyncio
+import os
+os.environ.setdefault("MONGOURI", "mongodb://localhost:27017")
+os.environ.setdefault("DBNAME", "bench")
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+
+from langchain_core.language_models.fake_chat_models import FakeMessagesListChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import InMemorySaver
+import bot
+from prompts import SYSTEM_PROMPTS, PROMPT_VERSION
+
+
+class counting_saver(InMemorySaver):
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+        self.puts = 0
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        self.bytes += len(self.serde.dumps_typed(checkpoint)[1])
+        self.puts += 1
+        return await super().aput(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        self.bytes += sum(len(self.serde.dumps_typed(value)[1]) for _, value in writes)
+        return await super().aput_writes(config, writes, task_id, task_path)
+
+
+def scripted_model(turns):
+    responses = []
+    for i in range(turns):
+        responses.append(AIMessage("", tool_calls=[{"name": "evaluate_expression", "args": {"expr": f"{70 + i}/1.75**2"}, "id": f"call_{i}"}]))
+        responses.append(AIMessage(f"Your BMI works out to about {(70 + i) / 1.75 ** 2:.1f}, which is in the healthy range. " * 3))
+    return FakeMessagesListChatModel(responses=responses)
+
+
+async def main(turns):
+    bot.llm = bot.fast_llm = scripted_model(turns)
+    saver = counting_saver()
+    graph = bot.build_graph(saver)
+    dynamic = f"{bot.get_current_datetime_response()}, Location of the user= lat=16.27939453125&lon=80.58837890625 \n User id: bench"
+    config = {"configurable": {"thread_id": "bench", "dynamic_system": dynamic}}
+    print(f"static prompt {PROMPT_VERSION}: {len(SYSTEM_PROMPTS[PROMPT_VERSION])} chars")
+    print(f"{'turn':>4}{'puts':>6}{'bytes':>10}")
+    for turn in range(turns):
+        before_bytes, before_puts = saver.bytes, saver.puts
+        await graph.ainvoke({"messages": [HumanMessage(f"I weigh {70 + turn} kg and I am 1.75 m tall, what is my BMI?")]}, config)
+        print(f"{turn:>4}{saver.puts - before_puts:>6}{saver.bytes - before_bytes:>10}")
+    print(f"average {saver.bytes / turns:.0f} bytes per turn")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=10)
+    asyncio.run(main(parser.parse_args().turns))
@@ -0,0 +1,289 @@
+# %%
+"""Throughput of /chat_message without gemini, bhuvan or duckduckgo.
+
+Boots the real `api` app in process under uvicorn with local stand-ins for everything
+outside it: a deterministic streaming chat model (configurable time to first token and
+per token latency, tool calls for BMI, hospital and search questions), a fake bhuvan
+behind the shared httpx client, fake search and disease retrieval modules and an in
+memory checkpointer. Then N SSE clients, each on its own chat, send their turns and
+the run reports p50/p95/p99 time to first token, turn latency and turns per second.
+
+    python bench_load.py --clients 50 --turns 4
+    python bench_load.py --clients 200 --token-latency 0.005 --json results.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import types
+import uuid
+from contextlib import asynccontextmanager
+
+os.environ.setdefault("MONGOURI", "mongodb://localhost:27017")
+os.environ.setdefault("DBNAME", "bench")
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+# the fake model has no quota, only the service itself is measured
+os.environ.setdefault("GEMINI_RPM", "1000000")
+os.environ.setdefault("GEMINI_TPM", "1000000000")
+# the disk caches and the hospital index of a run stay out of the working tree
+BENCH_DIR = tempfile.mkdtemp(prefix="bench_load_")
+os.environ.setdefault("HOSPITAL_INDEX_PATH", os.path.join(BENCH_DIR, "hospital_index.json"))
+os.environ.setdefault("RETRIEVAL_CACHE_PATH", os.path.join(BENCH_DIR, "retrieval_cache.sqlite3"))
+
+import httpx
+import uvicorn
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langgraph.checkpoint.memory import InMemorySaver
+
+LAT, LON = 16.27939453125, 80.58837890625
+MESSAGES = [
+    "hello there",
+    "I weigh 72 kg and I am 1.75 m tall, what is my BMI?",
+    "find hospitals near me",
+    "search the symptoms of dengue fever",
+    "thanks",
+]
+
+
+# %%
+class fake_chat_model(BaseChatModel):
+    """answers from a script keyed on the last message, streams word by word"""
+
+    first_token_latency: float = 0.2
+    token_latency: float = 0.02
+    answer_words: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "bench-fake"
+
+    def script(self, messages) -> AIMessage:
+        last = messages[-1]
+        if isinstance(last, ToolMessage):
+            return AIMessage(" ".join(["Here is what I found for you."] + ["detail"] * self.answer_words))
+        text = last.content.lower() if isinstance(last.content, str) else ""
+        call = None
+        if "bmi" in text:
+            call = {"name": "evaluate_expression", "args": {"expr": "72/1.75**2"}}
+        elif "hospital" in text:
+            call = {"name": "api_retriver", "args": {"lat": LAT, "lon": LON, "k": 5}}
+        elif "search" in text or "symptom" in text:
+            call = {"name": "search_duckduckgo", "args": {"query": text}}
+        if call is not None:
+            return AIMessage("Let me check.", tool_calls=[dict(call, id=f"call_{uuid.uuid4().hex[:8]}")])
+        return AIMessage(" ".join(["Hello, how can I help you today?"] + ["word"] * (self.answer_words // 4)))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError("the benchmark only runs the async path")
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self.script(messages)
+        await asyncio.sleep(self.first_token_latency)
+        words = message.content.split(" ")
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            chunk = AIMessageChunk(content=word if i == 0 else " " + word)
+            if i == len(words) - 1:
+                chunk = chunk + AIMessageChunk(
+                    content="",
+                    tool_call_chunks=[{"name": c["name"], "args": json.dumps(c["args"]), "id": c["id"], "index": n}
+                                      for n, c in enumerate(message.tool_calls)],
+                    usage_metadata={"input_tokens": 50 * len(messages), "output_tokens": len(words),
+                                    "total_tokens": 50 * len(messages) + len(words)})
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(chunk.content, chunk=generation)
+            yield generation
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        merged = None
+        async for generation in self._astream(messages, stop, run_manager, **kwargs):
+            merged = generation if merged is None else merged + generation
+        message = merged.message
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(
+            content=message.content, tool_calls=message.tool_calls, usage_metadata=message.usage_metadata))])
+
+
+# %%
+def fake_bhuvan(latency: float):
+    """bhuvan's proximity api: a json list of hospitals scattered around the point"""
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        lat, lon = float(request.url.params["lat"]), float(request.url.params["lon"])
+        rng = random.Random(f"{lat:.3f},{lon:.3f}")
+        hospitals = [{"hospital_name": f"Bench Hospital {i}", "address": f"{i} Main Road",
+                      "contact_number": f"0863-{1000 + i}",
+                      "lat": lat + rng.uniform(-0.05, 0.05), "lon": lon + rng.uniform(-0.05, 0.05)}
+                     for i in range(20)]
+        return httpx.Response(200, json=hospitals)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def fake_module(name: str, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def install_fake_tools(latency: float):
+    """the lazy tools import these modules on first use, the fakes are found first"""
+
+    async def search_duckduckgo(query: str):
+        await asyncio.sleep(latency)
+        return json.dumps([{"title": f"{query} result {i}", "snippet": "bench snippet " * 10,
+                            "url": f"https://example.org/{i}"} for i in range(5)])
+
+    def disease_data_search_from_database(query: str):
+        time.sleep(latency)
+        return "\n".join(f"{query}: bench document {i}" for i in range(5))
+
+    sys.modules["web_search"] = fake_module("web_search", search_duckduckgo=search_duckduckgo,
+                                            search_stats=lambda: {"fake": True})
+    sys.modules["gemini_embedding"] = fake_module(
+        "gemini_embedding", disease_data_search_from_database=disease_data_search_from_database)
+
+
+class memory_saver(InMemorySaver):
+    """InMemorySaver with the surface the api lifespan expects of mongo_saver"""
+
+    cache = None
+    write_behind = False
+    buffered: dict = {}
+    flushes: dict = {}
+    report: dict = {}
+
+    @classmethod
+    @asynccontextmanager
+    async def open(cls, conn_string=None, *, db_name, client=None):
+        yield cls()
+
+    async def flush(self, thread_id=None):
+        pass
+
+    async def run_compaction(self):
+        await asyncio.Event().wait()
+
+    async def run_flusher(self):
+        await asyncio.Event().wait()
+
+
+def load_app(model: fake_chat_model, upstream_latency: float):
+    install_fake_tools(upstream_latency)
+    import resources
+    resources.http_client = fake_bhuvan(upstream_latency)
+    import bot
+    bot.llm = bot.fast_llm = bot.summary_llm = model
+    import api
+    api.mongo_saver = memory_saver
+    return api.app
+
+
+# %%
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+async def client(http: httpx.AsyncClient, turns: int, results: list, errors: list):
+    chat_id = f"bench-{uuid.uuid4().hex[:12]}"
+    for i in range(turns):
+        message = MESSAGES[i % len(MESSAGES)]
+        started = time.perf_counter()
+        first = None
+        failed = False
+        try:
+            async with http.stream("POST", "/chat_message", json={"message": message, "id": chat_id}) as response:
+                async for line in response.aiter_lines():
+                    if line.startswith("event: error"):
+                        failed = True
+                    elif line.startswith("data:") and failed:
+                        errors.append(json.loads(line[len("data:"):]).get("error"))
+                        failed = False
+                    elif line.startswith("data:") and first is None:
+                        first = time.perf_counter() - started
+                if response.status_code != 200:
+                    errors.append(f"status {response.status_code}")
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+            continue
+        results.append((first, time.perf_counter() - started))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def main(args):
+    model = fake_chat_model(first_token_latency=args.first_token_latency, token_latency=args.token_latency,
+                            answer_words=args.answer_words)
+    app = load_app(model, args.upstream_latency)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                                           lifespan="on"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        if serving.done():
+            raise SystemExit("the server did not start")
+        await asyncio.sleep(0.05)
+
+    results, errors = [], []
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits,
+                                 timeout=httpx.Timeout(args.timeout)) as http:
+        if args.warmup:
+            # one chat through every scripted message first, so lazy imports (tool modules,
+            # the hospital index) are not counted against the first wave of clients
+            await client(http, len(MESSAGES), [], [])
+        started = time.perf_counter()
+        await asyncio.gather(*(client(http, args.turns, results, errors) for _ in range(args.clients)))
+        wall = time.perf_counter() - started
+    server.should_exit = True
+    await serving
+
+    ttft = [first for first, _ in results if first is not None]
+    total = [seconds for _, seconds in results]
+    report = {
+        "clients": args.clients, "turns": len(results), "errors": len(errors), "seconds": round(wall, 3),
+        "turns_per_second": round(len(results) / wall, 2),
+        "ttft_ms": {f"p{p}": round(percentile(ttft, p) * 1e3, 1) for p in (50, 95, 99)},
+        "turn_ms": {f"p{p}": round(percentile(total, p) * 1e3, 1) for p in (50, 95, 99)},
+    }
+    print(f"{report['clients']} clients, {report['turns']} turns in {report['seconds']}s "
+          f"({report['turns_per_second']} turns/s), {report['errors']} errors")
+    print(f"{'':>12}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name in ("ttft_ms", "turn_ms"):
+        print(f"{name:>12}" + "".join(f"{report[name][p]:>10}" for p in ("p50", "p95", "p99")))
+    if errors:
+        print("errors:", {error: errors.count(error) for error in set(map(str, errors))})
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=20, help="concurrent SSE clients, one chat each")
+    parser.add_argument("--turns", type=int, default=len(MESSAGES), help="turns per client")
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--answer-words", type=int, default=40)
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="bhuvan, search and retrieval")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false")
+    parser.add_argument("--json", help="also write the report to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,65 @@
+# %%
+"""Cold start of the agent service: import time per module and time until the app is ready.
+
+Imports `api` in a fresh interpreter with `-X importtime` and sums the self time of
+every module into its top level package, so the cost of a heavy dependency shows up
+under its own name and under the repo module that pulled it in.
+
+    python bench_startup.py --top 25
+    python bench_startup.py --module bot
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+os.environ.setdefault("MONGOURI", "mongodb://localhost:27017")
+os.environ.setdefault("DBNAME", "bench")
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_MODULES = {name[:-3] for name in os.listdir(HERE) if name.endswith(".py")}
+
+
+def import_times(module: str):
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         cwd=HERE, capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if out.returncode != 0:
+        raise SystemExit(out.stderr[-2000:])
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return rows, wall
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="api")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    rows, wall = import_times(args.module)
+    packages = defaultdict(int)
+    repo = {}
+    for name, self_us, cumulative_us in rows:
+        packages[name.strip().split(".")[0]] += self_us
+        if name.strip() in REPO_MODULES:
+            repo[name.strip()] = cumulative_us
+    print(f"python -c 'import {args.module}': {wall:.2f}s wall, {len(rows)} modules")
+    print(f"\n{'repo module':<28}{'cumulative ms':>14}")
+    for name, us in sorted(repo.items(), key=lambda item: -item[1]):
+        print(f"{name:<28}{us / 1e3:>14.1f}")
+    print(f"\n{'package':<28}{'self ms':>14}")
+    for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<28}{us / 1e3:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# %%
+"""Recall vs latency of the ivf mode of vector_index against exact search.
+
+    python bench_vector_index.py                     # index exported to VECTOR_INDEX_DIR
+    python bench_vector_index.py --synthetic 20000   # clustered random corpus, no export needed
+"""
+import argparse
+import time
+import numpy as np
+from vector_index import VECTOR_INDEX_DIR, local_vector_index, normalize_rows
+
+
+def synthetic_corpus(n: int, dim: int, clusters: int = 200, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.standard_normal((clusters, dim)).astype(np.float32))
+    rows = centers[rng.integers(0, clusters, n)] + 2.0 * rng.standard_normal((n, dim)).astype(np.float32) / np.sqrt(dim)
+    return normalize_rows(rows).astype(np.float32)
+
+
+def timed(fn, queries):
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        results.append(fn(q)[0])
+        latencies.append((time.perf_counter() - start) * 1e3)
+    return results, np.asarray(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--synthetic", type=int, default=0, help="corpus size of a synthetic corpus")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nlist", type=int, default=64)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    if args.synthetic:
+        index = local_vector_index(synthetic_corpus(args.synthetic, args.dim), [], nlist=args.nlist)
+    else:
+        index = local_vector_index.load(VECTOR_INDEX_DIR, nlist=args.nlist)
+    start = time.perf_counter()
+    index.build_ivf()
+    print(f"corpus {index.matrix.shape}, ivf build with nlist={args.nlist}: {time.perf_counter() - start:.2f}s")
+
+    # queries close to but not equal to corpus rows, like a user question near a document
+    rng = np.random.default_rng(1)
+    base = np.asarray(index.matrix[rng.integers(0, index.matrix.shape[0], args.queries)])
+    queries = normalize_rows(base + 0.05 * rng.standard_normal(base.shape).astype(np.float32)).astype(np.float32)
+
+    truth, exact_ms = timed(lambda q: index.search_exact(q, args.k), queries)
+    print(f"{'mode':<12}{'recall@' + str(args.k):>10}{'p50 ms':>10}{'p95 ms':>10}")
+    print(f"{'exact':<12}{1.0:>10.3f}{np.percentile(exact_ms, 50):>10.3f}{np.percentile(exact_ms, 95):>10.3f}")
+    for nprobe in args.nprobe:
+        found, ivf_ms = timed(lambda q: index.search_ivf(q, args.k, nprobe), queries)
+        recall = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+        print(f"{'ivf/' + str(nprobe):<12}{recall:>10.3f}{np.percentile(ivf_ms, 50):>10.3f}{np.percentile(ivf_ms, 95):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,13 @@
 
 # %%
 from typing import Annotated
-import requests
 from pydantic import BaseModel, Field
 from langchain.tools import StructuredTool
 from dotenv import load_dotenv
 import os
-# from neo4j_tool import neo4j_retriever
+import json
+from resources import session, timeout
+from doctor_lookup import find_doctors
 
 load_dotenv()
 # %%
@@ -58,7 +59,7 @@ def api_retriver(lat: Annotated[int,"latitude from the location of the user"],lo
     "buffer": radius,
     "token": access_token
     }
-    response = requests.get(url,params=params)
+    response = session().get(url,params=params,timeout=timeout())
     if response.status_code == 200:
         data = response.content
         if (str(data) != "b'false '"):
@@ -73,15 +74,13 @@ def api_retriver(lat: Annotated[int,"latitude from the location of the user"],lo
 
 
 def get_doctors_information(doctor_field: str,hospital_names: list[str]):
-    query = f"""
-    find the doctors according to following given information
-    doctor_field:{doctor_field},
-    hospitals to search for -- {hospital_names}
-    """
-    # result = neo4j_retriever(query=query) #get name of the doctor and its time slot from the database
-    # result = get_doctors_info(query=query)
-    result = "Dr. Mehra , time slots: Morning 9 am to 12 am and evening 4 pm to 7 pm"
-    return result
+    result = find_doctors(doctor_field, hospital_names)
+    if result is None:
+        # no doctor graph configured (no neo4j, no seed file)
+        return "Dr. Mehra , time slots: Morning 9 am to 12 am and evening 4 pm to 7 pm"
+    if not result["doctors"]:
+        return f"no {doctor_field} found at {', '.join(result['no_doctors_at'])}"
+    return json.dumps(result, ensure_ascii=False)
 
 # %%
 tool_doctor = StructuredTool.from_function(
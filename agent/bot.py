@@ -1,28 +1,31 @@
 # %%
 import os
-from sympy import sympify, N
-from sympy.core.sympify import SympifyError
-import re
-from typing import Annotated
-import math
-import requests
-from ddgs import DDGS
+import json
+import asyncio
+import operator
+import time
+import httpx
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, START, END
 from langchain.tools import tool
-from pydantic import BaseModel, computed_field, field_validator
+from pydantic import BaseModel, Field, field_validator
 from typing import Annotated
-from langchain_core.messages import ToolMessage, SystemMessage, AnyMessage,BaseMessage
-from langgraph.checkpoint.mongodb import MongoDBSaver
-from pymongo import MongoClient
+from langchain_core.messages import ToolMessage, SystemMessage, AnyMessage,HumanMessage
 from langgraph.graph.message import add_messages,RemoveMessage
 from datetime import datetime
 from langchain.prompts import PromptTemplate
-from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableConfig
+from tokens import message_tokens, uncounted
+from prompts import SYSTEM_PROMPTS, PROMPT_VERSION
 from booking import tool_doctor
-from gemini_embedding import disease_data_search_from_database
+from hospital_cache import hospital_cache, parse_hospitals, compact_hospitals
+from hospital_index import hospitals_index
+from resources import http
+from slots import inventory, slot_error
+from scheduler import scheduler, overloaded
+from router import classify, route_stats, FULL_MODEL, FAST_MODEL
+from tool_registry import evaluate_expression, search_duckduckgo, search_disease_info
 
 
 # %%
@@ -35,85 +38,51 @@ def get_current_datetime_response():
     return response
 
 # %%
-client = MongoClient(os.environ["MONGOURI"])
-collection = client[os.getenv("DBNAME")]["bookings"]
-checkpointer = MongoDBSaver(client=client,db_name=os.environ["DBNAME"])
+class appointment_request(BaseModel):
+    doctor: str = Field(description="name of the doctor as the doctors tool gave it")
+    hospital: str = Field(description="hospital of the doctor")
+    date: str = Field(description="day of the appointment, YYYY-MM-DD")
+    time: str = Field(description="start of the slot, HH:MM as check_availability gave it")
 
 @tool
-def book_appointment(hospitals: list[str],doctors: list[str],user_id: str):
-    """this tool gives the user options to select from the list of doctors and hospitals that you will give in this.
-    User id must be given or else the tool will fail"""
-    new = {
-        "_id":user_id,
-        "hospitals":hospitals,
-        "doctors":doctors
-    }
-    
-    collection.replace_one({"_id":user_id},new,upsert=True)
-    return "User was given options to select from the hospitals and doctors"
-    
-# book_appointment.invoke(input={"name":"book_appointment","id":"jdkjfslkdd","type":"tool_call",
-#                                "args":{"user_id":"sjdf","hospitals":["aims"],"doctors":["mehra"]}})
-
-# %%
-load_dotenv()
-
-# %%
-
-def replace_constants_in_expr(expr: str) -> str:
-    # Replace 'pi' and 'e' only when they appear as standalone tokens or parts of math expressions
-    replacements = {
-        r'\bpi\b': str(math.pi),     # \b ensures 'pi' is a word boundary
-        r'\be\b': str(math.e)
-    }
-    
-    for pattern, value in replacements.items():
-        expr = re.sub(pattern, value, expr)
-    
-    return expr
+def check_availability(doctor: str, hospital: str, date: str):
+    """free appointment slots (start times, HH:MM) of a doctor at a hospital on a day (YYYY-MM-DD).
+    Check before booking and offer the user some of these times"""
+    try:
+        free = inventory.free(doctor, hospital, date)
+    except slot_error as e:
+        return str(e)
+    return f"free slots of {doctor} on {date}: {', '.join(free)}" if free else f"{doctor} has no free slot on {date}"
 
+@tool
+def book_appointment(user_id: str, appointments: list[appointment_request]):
+    """book the appointments the user confirmed, several at once if they want more than one.
+    User id must be given or else the tool will fail"""
+    results = inventory.book(user_id, [a.model_dump() if isinstance(a, BaseModel) else a for a in appointments])
+    return json.dumps(results, ensure_ascii=False)
 
 @tool
-def evaluate_expression(expr: str) -> str:
-    '''Evaluates any maths expression'''
-    
+def cancel_appointment(user_id: str, doctor: str, hospital: str, date: str, time: str):
+    """cancel an appointment of the user, with the doctor, hospital, date and time it was booked for"""
     try:
-        expr = replace_constants_in_expr(expr)
-        # Parse the expression symbolically
-        symbolic_expr = sympify(expr)
-        # Evaluate to numeric value with 6 decimal precision
-        result = N(symbolic_expr, 6)
-        return str(result)
-    except SympifyError as e:
-        return f"Invalid expression: {e}"
-    except Exception as e:
-        return f"Error: {e}"
-
-
+        cancelled = inventory.cancel(user_id, doctor, hospital, date, time)
+    except slot_error as e:
+        return str(e)
+    return "the appointment was cancelled" if cancelled else "the user has no such appointment"
 
 # %%
-
-@tool
-def search_duckduckgo(query: str):
-    """search the web using DuckDuckGo"""
-    with DDGS() as ddgs:
-        results = ddgs.text(query,max_results=5)
-        return str(results)
-
+load_dotenv()
 
 # %%
-@tool
-def search_disease_info(query: str):
-    """a tool to search about a particular type of health issue or disease. It performs vector search
-    to get related info. The query given to this tool must be properly made so that you get relevant and
-    important information"""
-    return disease_data_search_from_database(query=query)
 
-@tool
-def api_retriver(lat: Annotated[int,"latitude from the location of the user"],lon: Annotated[int,"longitude from the location of the user"],radius:Annotated[int,"radius of the circle to search from the user. Less radius means close hospitals"]):
-    """get the nearest hospitals for the user using the bhuvan api,
-    the radius of searching that should be tried first is 1000 and if you don't get any hospitals you should try 3000 and
-    then you can if you don't get any hospital you can search in more radius"""
+# evaluate_expression, search_duckduckgo and search_disease_info live in tool_registry,
+# their implementations are imported on first use
+
+async def bhuvan_hospitals(lat: float, lon: float, radius: float):
+    """hospitals bhuvan knows within radius metres, None when bhuvan could not be reached"""
+    hospitals = hospital_cache.get(lat, lon, radius)
+    if hospitals is not None:
+        return hospitals
     access_token = os.getenv("BHUVAN_ACCESS_TOKEN")
 
     url = "https://bhuvan-app1.nrsc.gov.in/api/api_proximity/curl_hos_pos_prox.php"
@@ -124,79 +93,134 @@ def api_retriver(lat: Annotated[int,"latitude from the location of the user"],lo
     "buffer": radius,
     "token": access_token
     }
-    response = requests.get(url,params=params)
-    if response.status_code == 200:
-        data = response.content
-        if (str(data) != "b'false '"):
-            return (f"hospitals found {data}") 
-        else:
-            return "radius is too small to search for hospitals"
-    else:
-        return "ERROR retriving hospitals from the internet"
+    try:
+        response = await http().get(url,params=params)
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return None
+    hospitals = parse_hospitals(response.content)
+    if hospitals is None:
+        return None
+    hospital_cache.put(lat, lon, radius, hospitals)
+    # the circle is covered even when it added no hospital, bhuvan has none there
+    if hospitals_index.add(hospitals) | hospitals_index.cover(lat, lon, radius):
+        await asyncio.to_thread(hospitals_index.save)
+    return hospitals
+
+# candidates looked up beyond k, to fill in for duplicates and count the omitted ones
+HOSPITAL_CANDIDATES_EXTRA = 20
+
+@tool
+async def api_retriver(lat: Annotated[float,"latitude from the location of the user"],
+                       lon: Annotated[float,"longitude from the location of the user"],
+                       k: Annotated[int,"how many hospitals to return"] = 5,
+                       max_distance: Annotated[int,"farthest distance in metres the user can travel to a hospital"] = 10000):
+    """get the hospitals nearest to the user, sorted by distance. One call is enough, it always returns the
+    closest hospitals within max_distance. Only increase max_distance if the user is ready to travel farther.
+    Each hospital comes with its name, distance_m, phone and lat/lon, `omitted` counts further hospitals in reach"""
+    # a few more candidates than shown, so duplicates can be replaced and the
+    # answer can say how many more hospitals are in reach
+    candidates = k + HOSPITAL_CANDIDATES_EXTRA
+    if not hospitals_index.covers(lat, lon, max_distance):
+        # outside what bhuvan already answered the index may miss closer hospitals,
+        # bhuvan fills it in (or answers from the proximity cache)
+        fetched = await bhuvan_hospitals(lat, lon, max_distance)
+        if fetched is None and not hospitals_index.nearest(lat, lon, 1, max_distance):
+            return "ERROR retriving hospitals from the internet"
+    nearest = hospitals_index.nearest(lat, lon, candidates, max_distance)
+    if not nearest:
+        return f"no hospitals found within {max_distance} metres"
+    # `omitted` also counts the hospitals in reach beyond the candidates
+    total = hospitals_index.count(lat, lon, max_distance)
+    return json.dumps(compact_hospitals(nearest, k, total=total), ensure_ascii=False)
 # %%
-tools = [evaluate_expression, search_duckduckgo,book_appointment,api_retriver,tool_doctor,search_disease_info]
+tools = [evaluate_expression, search_duckduckgo,check_availability,book_appointment,cancel_appointment,api_retriver,tool_doctor,search_disease_info]
 
 
 
 
 # %%
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash").bind_tools(tools=tools)
+llm = ChatGoogleGenerativeAI(model=FULL_MODEL).bind_tools(tools=tools)
+# small talk, short follow-ups and summaries. It keeps the tools so a misrouted turn still works
+fast_llm = ChatGoogleGenerativeAI(model=FAST_MODEL).bind_tools(tools=tools)
 
-summary_llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
+summary_llm = ChatGoogleGenerativeAI(model=FAST_MODEL)
 
 # %%
 class chat(BaseModel):
-    static_system : str
-    dynamic_system : str
-    summary : str
+    # system prompt of the thread, written by `start` on its first turn so a new
+    # PROMPT_VERSION only applies to new threads
+    prompt_version : str = ""
+    summary : str = ""
     messages : Annotated[list[AnyMessage], add_messages]
+    # running token estimate of `messages`, every node adds the delta of what it adds or removes
+    token_total : Annotated[int, operator.add] = 0
+    # model of the current turn, set by `start` from the new user message (see router.py)
+    route : str = "full"
     @field_validator('summary', mode='before')
     def validate_summary(cls, v):
         """Ensure summary is always a string"""
         if hasattr(v, 'content'):
             return v.content  # Extract content from message objects
         return str(v)
-    
-    @computed_field(return_type=BaseMessage)
-    @property
-    def model_in_sys(self):
-        prompt = PromptTemplate.from_template("""{selfstatic_system} 
-                                              {selfdynamic_system}""")
-        return SystemMessage(prompt.format(selfstatic_system=self.static_system,selfdynamic_system=self.dynamic_system))
-    
-    @computed_field(return_type=BaseMessage)
-    @property
-    def model_in_summary(self):
-        prompt = PromptTemplate.from_template("""Long term memory with the user:\n
-                                              {summary} """)
-        return SystemMessage(prompt.format(summary=self.summary))
+
+
+# the model input prompts are built per run and never stored in the state
+def model_in_sys(chats: chat, config: RunnableConfig):
+    prompt = PromptTemplate.from_template("""{selfstatic_system} 
+                                          {selfdynamic_system}""")
+    return SystemMessage(prompt.format(selfstatic_system=SYSTEM_PROMPTS.get(chats.prompt_version, SYSTEM_PROMPTS[PROMPT_VERSION]),
+                                       selfdynamic_system=config["configurable"].get("dynamic_system", "")))
+
+def model_in_summary(chats: chat):
+    prompt = PromptTemplate.from_template("""Long term memory with the user:\n
+                                          {summary} """)
+    return SystemMessage(prompt.format(summary=chats.summary))
 
 
 
 # %%
-def chat_node(chats: chat):
-    input_ = [chats.model_in_sys]+[chats.model_in_summary]
+async def chat_node(chats: chat, config: RunnableConfig):
+    input_ = [model_in_sys(chats, config)]+[model_in_summary(chats)]
     input_ = input_ + chats.messages
-    response = llm.invoke(input_)
-    return {"messages":[response]}
+    # after a tool call the turn is a tool flow, the full model reads the results
+    route = chats.route if isinstance(chats.messages[-1], HumanMessage) else "full"
+    model, name = (fast_llm, FAST_MODEL) if route == "fast" else (llm, FULL_MODEL)
+    started = time.perf_counter()
+    response = await scheduler.call(model, input_, priority="chat")
+    route_stats.record(route, name, time.perf_counter() - started, response)
+    return {"messages":[response], "token_total": message_tokens(response)}
 
 # %%
 tool_dict = {tool.name : tool for tool in tools}
 
 # %%
-def tool_node(chat: chat):
+# seconds a single tool call may run before it is cancelled
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "20"))
+tool_timeouts = {
+    "evaluate_expression": 5,
+}
+
+async def run_tool_call(tool_call):
+    tool_name = tool_call["name"]
+    timeout = tool_timeouts.get(tool_name, TOOL_TIMEOUT)
+    try:
+        tool = tool_dict[tool_name]
+        tool_response = await asyncio.wait_for(tool.ainvoke(tool_call["args"]), timeout=timeout)
+        return ToolMessage(content=tool_response, name=tool_name, tool_call_id=tool_call["id"])
+    except asyncio.TimeoutError:
+        return ToolMessage(content=f"{tool_name} did not answer within {timeout} seconds, try again or use another tool",
+                           name=tool_name, tool_call_id=tool_call["id"])
+    except Exception as e:
+        return ToolMessage(content=f"{str(e)}", name = tool_name, tool_call_id=tool_call["id"])
+
+async def tool_node(chat: chat):
     tool_calls = chat.messages[-1].tool_calls
-    for tool_call in tool_calls:
-        tool_name = tool_call["name"]
-        try:
-            tool = tool_dict[tool_name]
-            tool_response = tool.invoke(tool_call["args"])
-            tool_message = ToolMessage(content=tool_response, name=tool_name, tool_call_id=tool_call["id"])
-            chat.messages.append(tool_message)
-        except Exception as e:
-            error_message = ToolMessage(content=f"{str(e)}", name = tool_name, tool_call_id=tool_call["id"])
-            chat.messages.append(error_message)
-    return chat
+    # every call of the AIMessage runs at once, gather keeps the original order
+    # and wait_for cancels a call that runs past its timeout
+    tool_messages = await asyncio.gather(*(run_tool_call(tool_call) for tool_call in tool_calls))
+    return {"messages": list(tool_messages), "token_total": sum(message_tokens(m) for m in tool_messages)}
 
 # %%
 def tool_call_condition(chats: chat):
@@ -207,33 +231,85 @@ def tool_call_condition(chats: chat):
 # %%
 
 def start(chats: chat):
-    return chats
+    # only the new input is tokenized, the rest of the thread is already counted
+    new = uncounted(chats.messages)
+    route, reason = classify(chats.messages)
+    route_stats.decided(route, reason)
+    update = {"route": route}
+    if not chats.prompt_version:
+        update["prompt_version"] = PROMPT_VERSION
+    if new:
+        update.update(messages=new, token_total=sum(message_tokens(m) for m in new))
+    return update
     
     
+# messages are summarized once they pass TOKEN_BUDGET, and enough of them are
+# evicted to get back under TOKEN_TARGET so the next turns don't summarize again
+TOKEN_BUDGET = 4000
+TOKEN_TARGET = 2500
+
 def token_count(chats: chat):
-    messages = chats.messages
-    tokens = count_tokens_approximately(messages=(m for m in messages),chars_per_token=3,extra_tokens_per_message=60)
-    if tokens > 4000:
+    if chats.token_total > TOKEN_BUDGET:
         return "exceeded"
     else:
         return "chat"
 
-def history(chats: chat):
-    message = chats.messages[0]
-    summary = SystemMessage(chats.summary)
-    
-    prompt = f"""Summarize the given messages. Summary must to be to the point and should be under 200 words
-    last user message: {message.content}
-    summary of a conversation: {chats.summary}
+def eviction_point(messages, total, target=TOKEN_TARGET):
+    """number of oldest messages to evict so the rest fits in target tokens, and the tokens they hold.
+    The cut is moved forward to the next user message, so an AIMessage with tool
+    calls is never separated from its ToolMessages and the kept window starts
+    with a user turn. The latest message is always kept."""
+    cut = 0
+    evicted = 0
+    while cut < len(messages) - 1 and total - evicted > target:
+        evicted += message_tokens(messages[cut])
+        cut += 1
+    while 0 < cut < len(messages) - 1 and not isinstance(messages[cut], HumanMessage):
+        evicted += message_tokens(messages[cut])
+        cut += 1
+    return cut, evicted
+
+def transcript(messages, limit=1000):
+    lines = []
+    for m in messages:
+        if isinstance(m, HumanMessage):
+            speaker = "user"
+        elif isinstance(m, ToolMessage):
+            speaker = f"tool {m.name}"
+        else:
+            speaker = "assistant"
+        content = m.content if isinstance(m.content, str) else str(m.content)
+        if getattr(m, "tool_calls", None):
+            content += f" (called {', '.join(call['name'] for call in m.tool_calls)})"
+        lines.append(f"{speaker}: {content[:limit]}")
+    return "\n".join(lines)
+
+async def history(chats: chat):
+    cut, evicted_tokens = eviction_point(chats.messages, chats.token_total)
+    evicted = chats.messages[:cut]
+    if not evicted:
+        return {}
+
+    prompt = f"""Update the long term memory of a conversation between a healthcare assistant and a user.
+    Keep what matters for later turns (symptoms, conditions, medicines, location, hospitals, doctors and bookings).
+    The memory must be to the point and should be under 200 words.
+    current memory: {chats.summary or "empty"}
+    messages to add to the memory:
+    {transcript(evicted)}
     """
-    
-    # model_in = [command]+[summary]+[message]
-    model_in = prompt
-    result = summary_llm.invoke(model_in).content
-    id_r = message.id
-    remove = RemoveMessage(id=str(id_r))
-    
-    return {"summary":"","messages":[remove]}
+
+    # one summarizer call for the whole evicted block, merged with the old summary
+    try:
+        started = time.perf_counter()
+        response = await scheduler.call(summary_llm, [HumanMessage(prompt)], priority="summary")
+        route_stats.record("summary", FAST_MODEL, time.perf_counter() - started, response)
+        result = response.content
+    except overloaded:
+        # the reply matters more than the memory, the history is summarized on a later turn
+        return {}
+    remove = [RemoveMessage(id=str(m.id)) for m in evicted]
+
+    return {"summary":result,"messages":remove,"token_total":-evicted_tokens}
 
 # %%
 builder = StateGraph(chat)
@@ -251,7 +327,7 @@ builder.add_conditional_edges(
         "chat":"chat_node"
     }
 )
-builder.add_edge("history","start")
+builder.add_edge("history","chat_node")
 builder.add_conditional_edges("chat_node"
                               , tool_call_condition,
                               {
@@ -261,7 +337,10 @@ builder.add_conditional_edges("chat_node"
                               )
 builder.add_edge("tools", "chat_node")
 
-graph = builder.compile(checkpointer=checkpointer)
+def build_graph(checkpointer):
+    # the async mongo checkpointer binds to the running event loop, so the
+    # graph is compiled from the api lifespan instead of at import time
+    return builder.compile(checkpointer=checkpointer)
 
 
 # %%
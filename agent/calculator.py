@@ -0,0 +1,226 @@
+# %%
+import ast
+import math
+import multiprocessing
+import operator
+import os
+import resource
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+MAX_EXPRESSION_CHARS = 500
+MAX_NODES = 200
+MAX_EXPONENT = 10000
+MAX_INT_BITS = 4096
+MAX_FACTORIAL = 500
+# round(x, n) builds 10**abs(n) internally
+MAX_ROUND_DIGITS = 1000
+# the sympy fallback runs in worker processes with these hard limits
+SYMPY_WORKERS = int(os.getenv("SYMPY_WORKERS", "1"))
+SYMPY_TIMEOUT = float(os.getenv("SYMPY_TIMEOUT", "5"))
+SYMPY_CPU_SECONDS = int(os.getenv("SYMPY_CPU_SECONDS", "5"))
+SYMPY_MEMORY_MB = int(os.getenv("SYMPY_MEMORY_MB", "1024"))
+
+
+class needs_sympy(Exception):
+    """the expression is valid python maths but not plain arithmetic (symbols, calculus...)"""
+
+
+class limit_error(ValueError):
+    """the input is past one of the limits above"""
+
+
+# %%
+def checked_pow(base, exponent):
+    if abs(exponent) > MAX_EXPONENT:
+        raise limit_error(f"exponent {exponent} is too large")
+    if isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and base not in (0, 1, -1):
+        if base.bit_length() * exponent > MAX_INT_BITS:
+            raise limit_error("result is too large")
+    return operator.pow(base, exponent)
+
+
+def checked_factorial(n):
+    if n != int(n) or not 0 <= n <= MAX_FACTORIAL:
+        raise limit_error(f"factorial is only computed for integers 0..{MAX_FACTORIAL}")
+    return math.factorial(int(n))
+
+
+def checked_round(x, ndigits=None):
+    if ndigits is None:
+        return round(x)
+    if ndigits != int(ndigits) or abs(ndigits) > MAX_ROUND_DIGITS:
+        raise limit_error(f"round only takes -{MAX_ROUND_DIGITS}..{MAX_ROUND_DIGITS} digits")
+    return round(x, int(ndigits))
+
+
+BINARY = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: checked_pow,
+}
+UNARY = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+CONSTANTS = {"pi": math.pi, "e": math.e, "E": math.e, "tau": math.tau}
+FUNCTIONS = {
+    "sqrt": math.sqrt, "cbrt": lambda x: math.copysign(abs(x) ** (1 / 3), x),
+    "exp": math.exp, "log": math.log, "ln": math.log, "log10": math.log10, "log2": math.log2,
+    "sin": math.sin, "cos": math.cos, "tan": math.tan,
+    "asin": math.asin, "acos": math.acos, "atan": math.atan, "atan2": math.atan2,
+    "sinh": math.sinh, "cosh": math.cosh, "tanh": math.tanh,
+    "degrees": math.degrees, "radians": math.radians,
+    "abs": abs, "Abs": abs, "round": checked_round, "floor": math.floor, "ceil": math.ceil,
+    "min": min, "max": max, "factorial": checked_factorial,
+}
+
+
+def evaluate_node(node):
+    if isinstance(node, ast.Expression):
+        return evaluate_node(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY:
+        return BINARY[type(node.op)](evaluate_node(node.left), evaluate_node(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY:
+        return UNARY[type(node.op)](evaluate_node(node.operand))
+    if isinstance(node, ast.Name) and node.id in CONSTANTS:
+        return CONSTANTS[node.id]
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS
+            and not node.keywords):
+        args = [evaluate_node(arg) for arg in node.args]
+        try:
+            return FUNCTIONS[node.func.id](*args)
+        except limit_error:
+            raise
+        except ValueError as e:
+            # outside the real domain (sqrt(-1), log(0)), sympy answers with I, zoo...
+            raise needs_sympy(str(e))
+    raise needs_sympy(ast.dump(node)[:80])
+
+
+def fast_evaluate(expr: str):
+    """numeric value of a plain arithmetic expression (`^` is a power, like in sympy).
+    Raises needs_sympy for anything else and ValueError for out of range input"""
+    if len(expr) > MAX_EXPRESSION_CHARS:
+        raise limit_error(f"expression longer than {MAX_EXPRESSION_CHARS} characters")
+    try:
+        tree = ast.parse(expr.strip().replace("^", "**"), mode="eval")
+    except SyntaxError as e:
+        raise needs_sympy(str(e))
+    if sum(1 for _ in ast.walk(tree)) > MAX_NODES:
+        raise limit_error("expression is too long")
+    try:
+        return evaluate_node(tree)
+    except (ZeroDivisionError, OverflowError) as e:
+        raise ValueError(str(e))
+
+
+def format_number(value) -> str:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, int):
+        return str(value)
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    # 6 significant digits, like N(expr, 6) did before
+    return f"{value:.6g}"
+
+
+# %%
+def limit_worker():
+    resource.setrlimit(resource.RLIMIT_AS, (SYMPY_MEMORY_MB * 2**20, SYMPY_MEMORY_MB * 2**20))
+
+
+def sympy_evaluate(expr: str) -> str:
+    # the cpu limit counts from the start of this call, a worker that goes over it is
+    # killed by SIGXCPU and the pool is rebuilt
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + SYMPY_CPU_SECONDS, hard))
+    from sympy import E, N, sympify
+    return str(N(sympify(expr, locals={"e": E}), 6))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def sympy_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the workers never inherit the sockets and threads of the api process
+            _pool = ProcessPoolExecutor(max_workers=SYMPY_WORKERS, initializer=limit_worker,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def reset_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_sympy(expr: str, timeout: float = SYMPY_TIMEOUT) -> str:
+    pool = sympy_pool()
+    try:
+        return pool.submit(sympy_evaluate, expr).result(timeout=timeout)
+    except FutureTimeoutError:
+        # the worker is still busy until its cpu limit kills it, new work goes to a fresh pool
+        reset_pool(pool)
+        raise TimeoutError(f"symbolic evaluation took longer than {timeout} seconds")
+    except BrokenProcessPool:
+        reset_pool(pool)
+        raise MemoryError("symbolic evaluation ran out of its cpu or memory limit")
+
+
+# %%
+def evaluate(expr: str) -> str:
+    """plain arithmetic is evaluated in process from the ast, sympy only gets what
+    needs symbolic work and runs sandboxed in a worker process"""
+    try:
+        return format_number(fast_evaluate(expr))
+    except ValueError as e:
+        return f"Error: {e}"
+    except needs_sympy:
+        pass
+    try:
+        return run_sympy(expr)
+    except (TimeoutError, MemoryError) as e:
+        return f"Error: {e}"
+    except Exception as e:
+        # SympifyError and friends come back pickled from the worker
+        if type(e).__name__ == "SympifyError":
+            return f"Invalid expression: {e}"
+        return f"Error: {e}"
+
+
+if __name__ == "__main__":
+    # expression -> expected answer, run after changing the evaluator: python calculator.py
+    CASES = {
+        "2+3*4": "14",
+        "2^10": "1024",
+        "72/1.75**2": "23.5102",
+        "sqrt(16)": "4",
+        # the real domain ends here, sympy answers like it did before the ast path
+        "sqrt(-1)": "1.0*I",
+        "round(2.675, 2)": "2.67",
+        # round builds 10**abs(ndigits), this one never returned
+        "round(1, -(10**1000))": f"Error: round only takes -{MAX_ROUND_DIGITS}..{MAX_ROUND_DIGITS} digits",
+        "10**100000": "Error: exponent 100000 is too large",
+        "factorial(1000)": f"Error: factorial is only computed for integers 0..{MAX_FACTORIAL}",
+    }
+    failed = 0
+    for expr, expected in CASES.items():
+        answer = evaluate(expr)
+        if answer != expected:
+            failed += 1
+            print(f"FAIL {expr}: {answer!r}, expected {expected!r}")
+    print(f"{len(CASES) - failed}/{len(CASES)} cases ok")
+    raise SystemExit(1 if failed else 0)
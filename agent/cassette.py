@@ -0,0 +1,330 @@
+# %%
+"""Record real conversations, replay them offline against the current code.
+
+Recording: with CASSETTE_DIR set, the api binds `recorder` to the compiled graph and
+every finished turn is appended as one json line to `<CASSETTE_DIR>/<thread id>.jsonl`:
+the user message, each model response (with the node that asked for it), each tool
+call with its input, output and time. Cassettes hold what users told the assistant,
+so only record where that is allowed and keep them out of the repo.
+
+Replay: every cassette (one conversation) runs again through the real graph in a
+process pool, the models answer with the recorded responses and the tools with the
+recorded outputs, so only this repo's code is measured. Per conversation it reports
+time per node and tool, model and tool calls, checkpoint bytes and divergences (calls
+the recording has no answer for, or recorded answers never asked for), and compares
+with a stored baseline.
+
+    python cassette.py cassettes/ --save baseline.json
+    python cassette.py cassettes/ --baseline baseline.json --workers 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage, message_to_dict
+
+CASSETTE_DIR = os.getenv("CASSETTE_DIR", "")
+
+
+def cassette_path(directory: str, thread_id: str) -> str:
+    return os.path.join(directory, re.sub(r"[^\w.-]", "_", thread_id) + ".jsonl")
+
+
+def plain(value):
+    """tool inputs and outputs as json, whatever the tool returned"""
+    return json.loads(json.dumps(value, default=str))
+
+
+# %%
+class recorder(BaseCallbackHandler):
+    """collects each turn from the callback events and appends it when the turn ends"""
+
+    run_inline = True
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # run id -> id of the turn (root run) it belongs to
+        self.roots: dict = {}
+        self.turns: dict = {}
+        self.started: dict = {}
+        self.lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        if parent_run_id is None:
+            metadata = metadata or {}
+            messages = inputs.get("messages", []) if isinstance(inputs, dict) else []
+            text = next((m.content for m in reversed(messages) if isinstance(m, HumanMessage)), "")
+            self.turns[run_id] = {"thread_id": metadata.get("thread_id", "unknown"),
+                                  "at": datetime.now(timezone.utc).isoformat(),
+                                  "dynamic_system": metadata.get("dynamic_system"),
+                                  "input": text, "llm": [], "tools": [], "started": time.perf_counter()}
+            self.roots[run_id] = run_id
+        elif parent_run_id in self.roots:
+            self.roots[run_id] = self.roots[parent_run_id]
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        if parent_run_id in self.roots:
+            self.roots[run_id] = self.roots[parent_run_id]
+            self.started[run_id] = ((metadata or {}).get("langgraph_node"), time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        turn = self.turns.get(self.roots.pop(run_id, None))
+        node, started = self.started.pop(run_id, (None, time.perf_counter()))
+        if turn is not None:
+            turn["llm"].append({"node": node, "seconds": round(time.perf_counter() - started, 4),
+                                "message": message_to_dict(response.generations[0][0].message)})
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, inputs=None, **kwargs):
+        if parent_run_id in self.roots:
+            self.roots[run_id] = self.roots[parent_run_id]
+            name = kwargs.get("name") or (serialized or {}).get("name")
+            self.started[run_id] = ((name, inputs if inputs is not None else input_str), time.perf_counter())
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self.tool_done(run_id, output=plain(getattr(output, "content", output)))
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self.tool_done(run_id, error=str(error))
+
+    def tool_done(self, run_id, **result):
+        turn = self.turns.get(self.roots.pop(run_id, None))
+        (name, inputs), started = self.started.pop(run_id, ((None, None), time.perf_counter()))
+        if turn is not None:
+            turn["tools"].append(dict(name=name, input=plain(inputs),
+                                      seconds=round(time.perf_counter() - started, 4), **result))
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        if self.roots.get(run_id) != run_id:
+            self.roots.pop(run_id, None)
+            return
+        self.end_turn(run_id, error=None)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        if self.roots.get(run_id) != run_id:
+            self.roots.pop(run_id, None)
+            return
+        self.end_turn(run_id, error=str(error))
+
+    def end_turn(self, run_id, error):
+        self.roots.pop(run_id, None)
+        turn = self.turns.pop(run_id, None)
+        if turn is None:
+            return
+        turn["seconds"] = round(time.perf_counter() - turn.pop("started"), 4)
+        if error is not None:
+            turn["error"] = error
+        line = json.dumps(turn, ensure_ascii=False, default=str)
+        with self.lock, open(cassette_path(self.directory, turn["thread_id"]), "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def record(graph, directory: str = CASSETTE_DIR):
+    """the compiled graph with every turn recorded into `directory`"""
+    return graph.with_config(callbacks=[recorder(directory)])
+
+
+# %%
+# replay, runs in the worker processes
+def load_turns(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay_worker_init():
+    os.environ.setdefault("MONGOURI", "mongodb://localhost:27017")
+    os.environ.setdefault("DBNAME", "replay")
+    os.environ.setdefault("GOOGLE_API_KEY", "replay")
+    os.environ.setdefault("GEMINI_RPM", "1000000")
+    os.environ.setdefault("GEMINI_TPM", "1000000000")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def replay_conversation(path: str, realtime: bool = False) -> dict:
+    import asyncio
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, messages_from_dict
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from langchain_core.tools import StructuredTool
+    import bot
+    from bench_checkpoint_size import counting_saver
+    from metrics import metrics_handler
+
+    divergences = []
+
+    class replay_model(BaseChatModel):
+        """answers with the recorded responses of the current turn, in order"""
+
+        node: str
+        queue: list = []
+
+        @property
+        def _llm_type(self) -> str:
+            return "replay"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            raise NotImplementedError("replay only runs the async path")
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            if self.queue:
+                entry = self.queue.pop(0)
+                if realtime:
+                    await asyncio.sleep(entry["seconds"])
+                message = messages_from_dict([entry["message"]])[0]
+            else:
+                divergences.append(f"unrecorded {self.node} model call")
+                message = AIMessage("")
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+    class replay_timer(metrics_handler):
+        """the metrics handler, summing into dicts instead of prometheus"""
+
+        def __init__(self):
+            super().__init__()
+            self.seconds = defaultdict(float)
+            self.calls = defaultdict(int)
+
+        def finish(self, run_id, error: bool):
+            entry = self.started.pop(run_id, None)
+            if entry is not None:
+                kind, name, started = entry
+                self.seconds[f"{kind}:{name}"] += time.perf_counter() - started
+                self.calls[kind] += 1
+
+    chat_model, summary_model = replay_model(node="chat_node"), replay_model(node="history")
+    bot.llm = bot.fast_llm = chat_model
+    bot.summary_llm = summary_model
+    recorded_tools = defaultdict(list)
+
+    def replay_tool(original):
+        async def answer(**kwargs):
+            queue = recorded_tools[original.name]
+            entry = next((e for e in queue if e["input"] == plain(kwargs)), queue[0] if queue else None)
+            if entry is None:
+                divergences.append(f"unrecorded {original.name} call")
+                return f"{original.name} has no recorded answer"
+            queue.remove(entry)
+            if realtime:
+                await asyncio.sleep(entry["seconds"])
+            if "error" in entry:
+                raise RuntimeError(entry["error"])
+            return entry["output"]
+        return StructuredTool(name=original.name, description=original.description,
+                              args_schema=original.args_schema, coroutine=answer)
+
+    bot.tool_dict = {name: replay_tool(t) for name, t in bot.tool_dict.items()}
+    saver = counting_saver()
+    timer = replay_timer()
+    graph = bot.build_graph(saver).with_config(callbacks=[timer])
+    turns = load_turns(path)
+    thread_id = os.path.splitext(os.path.basename(path))[0]
+
+    async def run():
+        for n, turn in enumerate(turns):
+            chat_model.queue = [e for e in turn["llm"] if e["node"] != "history"]
+            summary_model.queue = [e for e in turn["llm"] if e["node"] == "history"]
+            recorded_tools.clear()
+            for entry in turn["tools"]:
+                recorded_tools[entry["name"]].append(entry)
+            config = {"configurable": {"thread_id": thread_id, "dynamic_system": turn.get("dynamic_system") or ""}}
+            await graph.ainvoke({"messages": [HumanMessage(turn["input"])]}, config)
+            left = len(chat_model.queue) + len(summary_model.queue) + sum(map(len, recorded_tools.values()))
+            if left:
+                divergences.append(f"turn {n}: {left} recorded calls not made")
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    return {"turns": len(turns), "seconds": round(time.perf_counter() - started, 4),
+            "llm_calls": timer.calls["llm"], "tool_calls": timer.calls["tool"],
+            "checkpoint_bytes": saver.bytes,
+            "node_seconds": {k: round(v, 4) for k, v in sorted(timer.seconds.items()) if k.startswith("node:")},
+            "tool_seconds": {k: round(v, 4) for k, v in sorted(timer.seconds.items()) if k.startswith("tool:")},
+            "divergences": divergences}
+
+
+# %%
+def cassettes(paths: list[str]) -> list[str]:
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl"))
+        else:
+            found.append(path)
+    return found
+
+
+def replay_all(paths: list[str], workers: int, realtime: bool) -> dict:
+    # spawned, every conversation gets a bot module nobody else patched before
+    with ProcessPoolExecutor(max_workers=workers, initializer=replay_worker_init,
+                             mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1) as pool:
+        futures = {os.path.basename(p): pool.submit(replay_conversation, os.path.abspath(p), realtime) for p in paths}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """regressions against the baseline: more model or tool calls, or node time / checkpoint
+    bytes grown by more than `threshold`"""
+    regressions = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for key in ("llm_calls", "tool_calls"):
+            if now[key] > before[key]:
+                regressions.append(f"{name}: {key} {before[key]} -> {now[key]}")
+        if now["checkpoint_bytes"] > before["checkpoint_bytes"] * (1 + threshold):
+            regressions.append(f"{name}: checkpoint bytes {before['checkpoint_bytes']} -> {now['checkpoint_bytes']}")
+        was, is_ = sum(before["node_seconds"].values()), sum(now["node_seconds"].values())
+        if was and is_ > was * (1 + threshold):
+            regressions.append(f"{name}: node time {was * 1e3:.0f} ms -> {is_ * 1e3:.0f} ms")
+    return regressions
+
+
+def print_report(results: dict, baseline: dict):
+    print(f"{'conversation':<32}{'turns':>6}{'llm':>6}{'tools':>6}{'node ms':>10}{'ckpt KB':>10}{'diverged':>10}")
+    for name, r in results.items():
+        node_ms = sum(r["node_seconds"].values()) * 1e3
+        line = (f"{name[:31]:<32}{r['turns']:>6}{r['llm_calls']:>6}{r['tool_calls']:>6}{node_ms:>10.1f}"
+                f"{r['checkpoint_bytes'] / 1024:>10.1f}{len(r['divergences']):>10}")
+        before = baseline.get(name)
+        if before is not None:
+            was = sum(before["node_seconds"].values()) * 1e3
+            line += f"   (was {before['llm_calls']} llm, {was:.1f} ms, {before['checkpoint_bytes'] / 1024:.1f} KB)"
+        print(line)
+    nodes = defaultdict(float)
+    for r in results.values():
+        for key, seconds in {**r["node_seconds"], **r["tool_seconds"]}.items():
+            nodes[key] += seconds
+    print("time per node and tool:", {k: f"{v * 1e3:.1f} ms" for k, v in sorted(nodes.items())})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="cassette files or directories of them")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--realtime", action="store_true", help="wait the recorded model and tool latencies")
+    parser.add_argument("--baseline", help="compare with this earlier --save")
+    parser.add_argument("--save", help="write the results, to be used as a baseline later")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+    results = replay_all(cassettes(args.paths), args.workers, args.realtime)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    sys.exit(1 if regressions else 0)
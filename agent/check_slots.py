@@ -0,0 +1,117 @@
+# %%
+"""slots.py against a real mongo.
+
+mongomock has no $bit, so the upserted `$bitsAllClear` / `$bit` booking path is only
+exercised by a real server. Runs on a scratch database of MONGOURI (dropped at the end)
+with an in memory doctor graph, each booker on its own slot_inventory like separate
+api processes, and exits non zero when a check fails:
+
+    MONGOURI=mongodb://localhost:27017 python check_slots.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import uuid
+from datetime import date, timedelta
+
+os.environ.setdefault("MONGOURI", "mongodb://localhost:27017")
+os.environ["DBNAME"] = f"slots_check_{uuid.uuid4().hex[:8]}"
+os.environ.setdefault("GOOGLE_API_KEY", "check")
+# the doctor cache of the check stays out of the working tree
+os.environ.setdefault("RETRIEVAL_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="check_slots_"), "cache.sqlite3"))
+
+import doctor_lookup
+import slots
+from resources import mongo
+
+DAY = (date.today() + timedelta(days=1)).isoformat()
+DOCTORS = [{"name": "Dr. Rao", "specialty": "ENT", "hospital": "Check Hospital",
+            "slots": "Morning 10 am to 1 pm"}]
+failures = []
+
+
+def check(name: str, ok: bool, detail=""):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}" + (f": {detail}" if detail and not ok else ""))
+    if not ok:
+        failures.append(name)
+
+
+def request(doctor: str, at: str, hospital: str = "Check Hospital") -> dict:
+    return {"doctor": doctor, "hospital": hospital, "date": DAY, "time": at}
+
+
+def race(doctor: str, times: list[str]) -> list[dict]:
+    """fresh inventories booking a new day of a doctor at once, one per time"""
+    bookers = len(times)
+    start = threading.Barrier(bookers)
+    results = [None] * bookers
+
+    def book(i: int):
+        inventory = slots.slot_inventory()
+        start.wait()
+        results[i] = inventory.book(f"racer-{i}", [request(doctor, times[i])])[0]
+
+    threads = [threading.Thread(target=book, args=(i,)) for i in range(bookers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main(args):
+    graph = doctor_lookup.memory_doctors()
+    graph.seed(DOCTORS)
+    doctor_lookup._backend = graph
+    db = mongo()[os.environ["DBNAME"]]
+    inventory = slots.slot_inventory()
+    try:
+        check("open hours from the doctor's schedule",
+              inventory.free("Dr. Rao", "Check Hospital", DAY) == ["10:00", "10:30", "11:00", "11:30", "12:00", "12:30"],
+              inventory.free("Dr. Rao", "Check Hospital", DAY))
+
+        result = inventory.book("user-1", [request("Dr. Rao", "10:00"), request("Dr. Rao", "16:00")])
+        check("first booking of a day upserts its document", result[0]["booked"], result)
+        check("closed hours are refused", not result[1]["booked"], result)
+        day = db["slot_days"].find_one({"_id": slots.day_id("Dr. Rao", "Check Hospital", DAY)})
+        check("the slot bit is set", day is not None and int(day["taken"]) == 1 << slots.parse_slot("10:00"), day)
+
+        stale = slots.slot_inventory()
+        stale.load({slots.day_id("Dr. Rao", "Check Hospital", DAY): ("Dr. Rao", "Check Hospital")})
+        inventory.book("user-2", [request("Dr. Rao", "10:30")])
+        result = stale.book("user-3", [request("Dr. Rao", "10:30")])[0]
+        check("a stale mirror loses on $bitsAllClear", not result["booked"], result)
+
+        booking = db["bookings"].find_one({"_id": "user-1"})
+        check("bookings holds the user's appointments",
+              booking is not None and booking["doctors"] == ["Dr. Rao"] and len(booking["appointments"]) == 1, booking)
+
+        check("cancel clears the bit", inventory.cancel("user-1", "Dr. Rao", "Check Hospital", DAY, "10:00")
+              and "10:00" in slots.slot_inventory().free("Dr. Rao", "Check Hospital", DAY))
+        booking = db["bookings"].find_one({"_id": "user-1"})
+        check("cancel updates bookings", booking is not None and booking["appointments"] == [], booking)
+
+        # doctors outside the graph are open SLOT_HOURS
+        times = [slots.slot_time(s) for s in range(slots.SLOTS_PER_DAY) if slots.DEFAULT_OPEN >> s & 1][:args.bookers]
+        results = race("Dr. Spread", times)
+        check(f"{len(times)} first bookings of a new day on different slots all win",
+              all(r["booked"] for r in results), results)
+
+        results = race("Dr. Same", [times[0]] * args.bookers)
+        check(f"{args.bookers} first bookings of one slot of a new day, one wins",
+              sum(r["booked"] for r in results) == 1, results)
+        for doctor, booked in (("Dr. Spread", len(times)), ("Dr. Same", 1)):
+            check(f"one appointment document per slot of {doctor}",
+                  db["appointments"].count_documents({"day_id": slots.day_id(doctor, "Check Hospital", DAY)}) == booked)
+    finally:
+        mongo().drop_database(os.environ["DBNAME"])
+    if failures:
+        sys.exit(f"{len(failures)} checks failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bookers", type=int, default=8, help="concurrent bookers of the race checks")
+    main(parser.parse_args())
@@ -0,0 +1,500 @@
+# %%
+"""Mongo checkpointer of the chat graph.
+
+Write-behind (opt in with CHECKPOINT_WRITE_BEHIND=1): the checkpoints and pending writes of a turn
+are kept in memory and sent as one ordered bulk_write per thread, when the turn ends
+(api.stream_chat flushes in a finally), when the thread is read again, or every
+CHECKPOINT_FLUSH_INTERVAL seconds. Tokens stream without waiting on Mongo in between.
+
+Crash safety: a process that dies mid turn loses the unflushed part of that turn. The
+thread resumes from the checkpoint of the previous turn, as if the last message had
+never been sent, it is never left half written because every flush is ordered and
+checkpoint documents go before the writes that point at them. A failed flush keeps the
+operations buffered and retries on the next flush. With write-behind off every put is
+a round trip and a crash loses at most the step in flight.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any
+import zstandard
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (WRITES_IDX_MAP, ChannelVersions, Checkpoint, CheckpointMetadata,
+                                       CheckpointTuple, copy_checkpoint, get_checkpoint_id)
+from langgraph.checkpoint.mongodb.aio import AsyncMongoDBSaver
+from langgraph.checkpoint.mongodb.utils import dumps_metadata
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+logger = logging.getLogger("checkpointer")
+
+# keep this many checkpoints per thread, older ones (and their writes) are compacted away
+CHECKPOINT_KEEP_LATEST = max(1, int(os.getenv("CHECKPOINT_KEEP_LATEST", "3")))
+CHECKPOINT_COMPACTION_INTERVAL = float(os.getenv("CHECKPOINT_COMPACTION_INTERVAL", "900"))
+# threads idle for longer are moved to the archive collection, 0 disables archival
+CHECKPOINT_ARCHIVE_AFTER_DAYS = float(os.getenv("CHECKPOINT_ARCHIVE_AFTER_DAYS", "30"))
+# archived threads are dropped by a mongo TTL index after this many days, 0 keeps them
+CHECKPOINT_ARCHIVE_EXPIRE_DAYS = float(os.getenv("CHECKPOINT_ARCHIVE_EXPIRE_DAYS", "0"))
+CHECKPOINT_COMPRESSION = os.getenv("CHECKPOINT_COMPRESSION", "zstd")
+CHECKPOINT_COMPRESSION_LEVEL = int(os.getenv("CHECKPOINT_COMPRESSION_LEVEL", "3"))
+# memory for the hot thread state cache, 0 disables it
+CHECKPOINT_CACHE_MB = float(os.getenv("CHECKPOINT_CACHE_MB", "64"))
+# buffer checkpoint writes and flush them once per turn, see the module docstring.
+# Off by default, it trades the unflushed part of a turn on a crash for latency
+CHECKPOINT_WRITE_BEHIND = os.getenv("CHECKPOINT_WRITE_BEHIND", "0") == "1"
+CHECKPOINT_FLUSH_INTERVAL = float(os.getenv("CHECKPOINT_FLUSH_INTERVAL", "5"))
+
+
+# %%
+class compressed_serializer:
+    """zstd around another serializer. The type tag gets a `+zstd` suffix, so blobs
+    written before compression was turned on (or below `min_size`) still load."""
+
+    def __init__(self, serde, level: int = CHECKPOINT_COMPRESSION_LEVEL, min_size: int = 256):
+        self.serde = serde
+        self.level = level
+        self.min_size = min_size
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(obj)
+        if len(data) < self.min_size:
+            return type_, data
+        return f"{type_}+zstd", zstandard.compress(data, self.level)
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        type_, blob = data
+        if type_.endswith("+zstd"):
+            return self.serde.loads_typed((type_[:-5], zstandard.decompress(blob)))
+        return self.serde.loads_typed(data)
+
+    def __getattr__(self, name):
+        return getattr(self.serde, name)
+
+
+# %%
+class hot_state_cache:
+    """Latest checkpoint (with its pending writes) of recently active threads, LRU
+    bounded by the serialized size of the checkpoints. Entries are looked up together
+    with the checkpoint id the database reports as latest and that checkpoint's
+    `writes_version` (bumped after every aput_writes), so a thread another process wrote
+    a checkpoint or pending writes to since is a miss and never a stale read."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries: OrderedDict[tuple[str, str], dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.check_seconds = 0.0
+        self.load_seconds = 0.0
+
+    def get(self, key, checkpoint_id, writes_version: int):
+        entry = self.entries.get(key)
+        if (entry is None or entry["config"]["configurable"]["checkpoint_id"] != checkpoint_id
+                or entry["writes_version"] != writes_version):
+            return None
+        self.entries.move_to_end(key)
+        return CheckpointTuple(entry["config"], copy_checkpoint(entry["checkpoint"]), entry["metadata"],
+                               entry["parent_config"], list(entry["writes"].values()))
+
+    def put(self, key, checkpoint_tuple: CheckpointTuple, size: int, writes_version: int = 0):
+        self.drop(key)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = {
+            "config": checkpoint_tuple.config,
+            "checkpoint": checkpoint_tuple.checkpoint,
+            "metadata": checkpoint_tuple.metadata,
+            "parent_config": checkpoint_tuple.parent_config,
+            "writes": OrderedDict(),
+            "writes_version": writes_version,
+            "size": size,
+        }
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted["size"]
+
+    def add_writes(self, key, checkpoint_id, writes, task_id, task_path):
+        entry = self.entries.get(key)
+        if entry is None or entry["config"]["configurable"]["checkpoint_id"] != checkpoint_id:
+            return
+        # same upsert rules as AsyncMongoDBSaver.aput_writes
+        replace = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+        for idx, (channel, value) in enumerate(writes):
+            write_key = (task_id, task_path, WRITES_IDX_MAP.get(channel, idx))
+            if replace or write_key not in entry["writes"]:
+                entry["writes"][write_key] = (task_id, channel, value)
+        entry["writes_version"] += 1
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry["size"]
+
+    def drop_thread(self, thread_id):
+        for key in [k for k in self.entries if k[0] == thread_id]:
+            self.drop(key)
+
+    def stats(self):
+        reads = self.hits + self.misses
+        check_ms = self.check_seconds / self.hits * 1e3 if self.hits else 0.0
+        load_ms = self.load_seconds / self.misses * 1e3 if self.misses else 0.0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / reads if reads else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "avg_hit_ms": check_ms,
+            "avg_miss_ms": load_ms,
+            # every hit skipped a full load (blob + writes) and only paid the version check
+            "saved_ms": max(0.0, load_ms - check_ms) * self.hits,
+        }
+
+
+# %%
+class mongo_saver(AsyncMongoDBSaver):
+    """AsyncMongoDBSaver with compressed blobs, an `updated_at` stamp on every
+    checkpoint, optional write-behind and a compaction job that enforces retention and
+    archives idle threads."""
+
+    def __init__(self, client, db_name: str, checkpoint_collection_name: str = "checkpoints",
+                 writes_collection_name: str = "checkpoint_writes", write_behind: bool = CHECKPOINT_WRITE_BEHIND,
+                 **kwargs):
+        super().__init__(client, db_name, checkpoint_collection_name, writes_collection_name, **kwargs)
+        self.write_behind = write_behind
+        # thread_id -> buffered operations of both collections, in the order they were made
+        self.buffered: dict[str, dict[str, list]] = {}
+        self.flush_lock = asyncio.Lock()
+        self.flushes = {"flushes": 0, "checkpoints": 0, "writes": 0, "failures": 0, "last_flush_ms": 0.0}
+        if CHECKPOINT_COMPRESSION == "zstd":
+            self.serde = compressed_serializer(self.serde)
+        self.archive_collection = self.db[f"{checkpoint_collection_name}_archive"]
+        self.archive_writes_collection = self.db[f"{writes_collection_name}_archive"]
+        # when compaction last ran and up to where it looked for idle threads, shared by the
+        # processes and kept across restarts so no run has to scan the whole collection
+        self.compaction_state = self.db[f"{checkpoint_collection_name}_compaction"]
+        self.cache = hot_state_cache(int(CHECKPOINT_CACHE_MB * 2**20)) if CHECKPOINT_CACHE_MB else None
+        self.report = {"runs": 0, "checkpoints_deleted": 0, "writes_deleted": 0,
+                       "threads_archived": 0, "threads_restored": 0, "bytes_reclaimed": 0, "last_run": None}
+
+    @classmethod
+    @asynccontextmanager
+    async def open(cls, conn_string: str | None = None, *, db_name: str, client=None, **kwargs):
+        """saver on a client of its own (conn_string) or on a shared one, which is left open"""
+        owned = client is None
+        if owned:
+            client = AsyncIOMotorClient(conn_string)
+        try:
+            saver = cls(client, db_name, **kwargs)
+            await saver.setup()
+            yield saver
+        finally:
+            if owned:
+                client.close()
+
+    async def setup(self):
+        await self._setup()
+        await self.checkpoint_collection.create_index([("updated_at", 1)])
+        await self.checkpoint_collection.create_index([("thread_id", 1), ("updated_at", -1)])
+        await self.archive_collection.create_index([("thread_id", 1), ("checkpoint_ns", 1)])
+        await self.archive_writes_collection.create_index([("thread_id", 1), ("checkpoint_ns", 1)])
+        if CHECKPOINT_ARCHIVE_EXPIRE_DAYS:
+            await self.archive_collection.create_index(
+                [("archived_at", 1)], expireAfterSeconds=int(CHECKPOINT_ARCHIVE_EXPIRE_DAYS * 86400))
+            await self.archive_writes_collection.create_index(
+                [("archived_at", 1)], expireAfterSeconds=int(CHECKPOINT_ARCHIVE_EXPIRE_DAYS * 86400))
+
+    # %%
+    async def aget_tuple(self, config: RunnableConfig):
+        await self.flush(config["configurable"]["thread_id"])
+        if self.cache is None:
+            return await self.load_tuple(config)
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        key = (thread_id, checkpoint_ns)
+        started = time.perf_counter()
+        explicit_id = get_checkpoint_id(config)
+        # the version check: one indexed lookup of the newest (or the asked for) checkpoint
+        # and how often pending writes were added to it
+        query = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}
+        if explicit_id is not None:
+            query["checkpoint_id"] = explicit_id
+        latest = await self.checkpoint_collection.find_one(
+            query, {"checkpoint_id": 1, "writes_version": 1, "_id": 0}, sort=[("checkpoint_id", -1)])
+        checkpoint_id = latest["checkpoint_id"] if latest else None
+        writes_version = latest.get("writes_version", 0) if latest else 0
+        cached = self.cache.get(key, checkpoint_id, writes_version) if checkpoint_id else None
+        if cached is not None:
+            self.cache.hits += 1
+            self.cache.check_seconds += time.perf_counter() - started
+            return cached
+        result = await self.load_tuple(config)
+        self.cache.misses += 1
+        self.cache.load_seconds += time.perf_counter() - started
+        # only a clean latest checkpoint is cached, loaded writes lack the index they were upserted with
+        if (result is not None and explicit_id is None and not result.pending_writes
+                and result.config["configurable"]["checkpoint_id"] == checkpoint_id):
+            inner = getattr(self.serde, "serde", self.serde)
+            self.cache.put(key, result, len(inner.dumps_typed(result.checkpoint)[1]), writes_version)
+        return result
+
+    async def load_tuple(self, config: RunnableConfig):
+        result = await super().aget_tuple(config)
+        if result is None and CHECKPOINT_ARCHIVE_AFTER_DAYS and await self.restore(config):
+            result = await super().aget_tuple(config)
+        return result
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        # same document as AsyncMongoDBSaver.aput plus `updated_at`, which drives archival
+        await self._setup()
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        checkpoint_id = checkpoint["id"]
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        doc = {
+            "parent_checkpoint_id": config["configurable"].get("checkpoint_id"),
+            "type": type_,
+            "checkpoint": serialized_checkpoint,
+            "metadata": dumps_metadata(metadata),
+            "updated_at": datetime.now(timezone.utc),
+        }
+        upsert_query = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}
+        if self.write_behind:
+            self.buffer(thread_id)["checkpoints"].append(UpdateOne(upsert_query, {"$set": doc}, upsert=True))
+        else:
+            await self.checkpoint_collection.update_one(upsert_query, {"$set": doc}, upsert=True)
+        new_config = {"configurable": upsert_query}
+        if self.cache is not None:
+            # write through: cached once the document is stored or buffered, a buffered
+            # thread is flushed before its next read so the version check still holds
+            parent_config = ({"configurable": dict(upsert_query, checkpoint_id=doc["parent_checkpoint_id"])}
+                             if doc["parent_checkpoint_id"] else None)
+            self.cache.put((thread_id, checkpoint_ns),
+                           CheckpointTuple(new_config, checkpoint, metadata, parent_config, []),
+                           len(serialized_checkpoint))
+        return new_config
+
+    async def aput_writes(self, config: RunnableConfig, writes, task_id: str, task_path: str = "") -> None:
+        # same operations as AsyncMongoDBSaver.aput_writes, buffered in write-behind mode
+        await self._setup()
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        set_method = "$set" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "$setOnInsert"
+        operations = []
+        for idx, (channel, value) in enumerate(writes):
+            upsert_query = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id,
+                            "task_id": task_id, "task_path": task_path, "idx": WRITES_IDX_MAP.get(channel, idx)}
+            type_, serialized_value = self.serde.dumps_typed(value)
+            operations.append(UpdateOne(upsert_query, {set_method: {"channel": channel, "type": type_,
+                                                                    "value": serialized_value}}, upsert=True))
+        if not operations:
+            return
+        # bumped after the writes are stored, the version check of other processes sees them
+        version = UpdateOne({"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id},
+                            {"$inc": {"writes_version": 1}})
+        if self.write_behind:
+            self.buffer(thread_id)["writes"].extend(operations)
+            self.buffer(thread_id)["versions"].append(version)
+        else:
+            await self.writes_collection.bulk_write(operations)
+            await self.checkpoint_collection.bulk_write([version])
+        if self.cache is not None:
+            self.cache.add_writes((config["configurable"]["thread_id"], config["configurable"]["checkpoint_ns"]),
+                                  config["configurable"]["checkpoint_id"], writes, task_id, task_path)
+
+    async def alist(self, config: RunnableConfig | None, **kwargs):
+        await self.flush(config["configurable"]["thread_id"] if config else None)
+        async for checkpoint_tuple in super().alist(config, **kwargs):
+            yield checkpoint_tuple
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        self.buffered.pop(thread_id, None)
+        if self.cache is not None:
+            self.cache.drop_thread(thread_id)
+        await super().adelete_thread(thread_id)
+
+    # %%
+    def buffer(self, thread_id: str) -> dict[str, list]:
+        return self.buffered.setdefault(thread_id, {"checkpoints": [], "writes": [], "versions": []})
+
+    async def flush(self, thread_id: str | None = None):
+        """send the buffered operations of one thread (or of all threads) to mongo"""
+        if not self.buffered:
+            return
+        async with self.flush_lock:
+            threads = [thread_id] if thread_id is not None else list(self.buffered)
+            for thread in threads:
+                ops = self.buffered.pop(thread, None)
+                if not ops:
+                    continue
+                started = time.perf_counter()
+                try:
+                    # checkpoints first: writes are only ever read through their checkpoint
+                    if ops["checkpoints"]:
+                        await self.checkpoint_collection.bulk_write(ops["checkpoints"], ordered=True)
+                        self.flushes["checkpoints"] += len(ops["checkpoints"])
+                        ops["checkpoints"] = []
+                    if ops["writes"]:
+                        await self.writes_collection.bulk_write(ops["writes"], ordered=True)
+                        self.flushes["writes"] += len(ops["writes"])
+                        ops["writes"] = []
+                    if ops["versions"]:
+                        await self.checkpoint_collection.bulk_write(ops["versions"], ordered=True)
+                        ops["versions"] = []
+                except Exception:
+                    # the upserts are idempotent, keep what did not go through for the next flush
+                    self.flushes["failures"] += 1
+                    later = self.buffered.pop(thread, {"checkpoints": [], "writes": [], "versions": []})
+                    self.buffered[thread] = {key: ops[key] + later[key] for key in ("checkpoints", "writes", "versions")}
+                    raise
+                self.flushes["flushes"] += 1
+                self.flushes["last_flush_ms"] = (time.perf_counter() - started) * 1e3
+
+    async def run_flusher(self, interval: float = CHECKPOINT_FLUSH_INTERVAL):
+        """flushes turns that never reached their end (cancelled streams) on an interval"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("checkpoint flush failed")
+
+    # %%
+    async def collection_bytes(self, collection, query) -> int:
+        result = await collection.aggregate([
+            {"$match": query},
+            {"$group": {"_id": None, "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}},
+        ]).to_list(1)
+        return result[0]["bytes"] if result else 0
+
+    async def enforce_retention(self, thread_id: str, checkpoint_ns: str, keep: int = CHECKPOINT_KEEP_LATEST):
+        """delete all but the `keep` newest checkpoints of a thread and their pending writes"""
+        query = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}
+        old = await self.checkpoint_collection.find(query, {"checkpoint_id": 1}).sort(
+            "checkpoint_id", -1).skip(keep).to_list(None)
+        if not old:
+            return 0, 0, 0
+        ids = [doc["checkpoint_id"] for doc in old]
+        old_query = dict(query, checkpoint_id={"$in": ids})
+        reclaimed = (await self.collection_bytes(self.checkpoint_collection, old_query)
+                     + await self.collection_bytes(self.writes_collection, old_query))
+        checkpoints = await self.checkpoint_collection.delete_many(old_query)
+        writes = await self.writes_collection.delete_many(old_query)
+        return checkpoints.deleted_count, writes.deleted_count, reclaimed
+
+    async def archive_idle(self, idle_for: timedelta, since: datetime | None = None):
+        """move the latest checkpoint of threads idle for longer than `idle_for` to the archive.
+        Only threads written between the cutoff of the previous run (`since`) and this one's
+        can have become idle since, they are found through the updated_at index"""
+        cutoff = datetime.now(timezone.utc) - idle_for
+        window = {"$gte": since, "$lt": cutoff} if since else {"$lt": cutoff}
+        idle = self.checkpoint_collection.aggregate([
+            {"$match": {"updated_at": window}},
+            {"$group": {"_id": {"thread_id": "$thread_id", "checkpoint_ns": "$checkpoint_ns"}}},
+        ])
+        archived, reclaimed = 0, 0
+        async for group in idle:
+            query = group["_id"]
+            # written to after the cutoff, not idle (the thread_id, updated_at index)
+            if await self.checkpoint_collection.find_one(dict(query, updated_at={"$gte": cutoff}), {"_id": 1}):
+                continue
+            latest = await self.checkpoint_collection.find_one(query, sort=[("checkpoint_id", -1)])
+            if latest is None:
+                continue
+            writes = await self.writes_collection.find(dict(query, checkpoint_id=latest["checkpoint_id"])).to_list(None)
+            now = datetime.now(timezone.utc)
+            await self.archive_collection.delete_many(query)
+            await self.archive_writes_collection.delete_many(query)
+            await self.archive_collection.insert_one(dict(latest, archived_at=now))
+            if writes:
+                await self.archive_writes_collection.insert_many([dict(w, archived_at=now) for w in writes])
+            # the thread may have been written to since the aggregation, only drop it if it is still idle
+            if await self.checkpoint_collection.find_one(dict(query, updated_at={"$gte": cutoff})):
+                await self.archive_collection.delete_many(query)
+                await self.archive_writes_collection.delete_many(query)
+                continue
+            # bounded by the archived checkpoint so a turn that starts right now keeps its new documents
+            stale = dict(query, checkpoint_id={"$lte": latest["checkpoint_id"]})
+            reclaimed += (await self.collection_bytes(self.checkpoint_collection, stale)
+                          + await self.collection_bytes(self.writes_collection, stale))
+            await self.checkpoint_collection.delete_many(stale)
+            await self.writes_collection.delete_many(stale)
+            archived += 1
+        return archived, reclaimed, cutoff
+
+    async def restore(self, config: RunnableConfig) -> bool:
+        """bring an archived thread back when its user returns"""
+        query = {"thread_id": config["configurable"]["thread_id"],
+                 "checkpoint_ns": config["configurable"].get("checkpoint_ns", "")}
+        archived = await self.archive_collection.find_one(query)
+        if archived is None:
+            return False
+        archived.pop("archived_at", None)
+        archived["updated_at"] = datetime.now(timezone.utc)
+        await self.checkpoint_collection.replace_one(
+            dict(query, checkpoint_id=archived["checkpoint_id"]), archived, upsert=True)
+        async for write in self.archive_writes_collection.find(query):
+            write.pop("archived_at", None)
+            await self.writes_collection.replace_one({"_id": write["_id"]}, write, upsert=True)
+        await self.archive_collection.delete_many(query)
+        await self.archive_writes_collection.delete_many(query)
+        self.report["threads_restored"] += 1
+        return True
+
+    # %%
+    async def compact(self):
+        await self.flush()
+        started = datetime.now(timezone.utc)
+        # documents written before `updated_at` existed start their idle clock now
+        await self.checkpoint_collection.update_many({"updated_at": {"$exists": False}}, {"$set": {"updated_at": started}})
+        state = await self.compaction_state.find_one({"_id": "state"}) or {}
+        # only the first run ever groups every thread
+        since = {"updated_at": {"$gte": state["last_run"]}} if state.get("last_run") else {}
+        checkpoints = writes = reclaimed = 0
+        # only threads written since the last run can have gone past the retention limit
+        touched = self.checkpoint_collection.aggregate([
+            {"$match": since},
+            {"$group": {"_id": {"thread_id": "$thread_id", "checkpoint_ns": "$checkpoint_ns"}}},
+        ])
+        async for group in touched:
+            c, w, b = await self.enforce_retention(group["_id"]["thread_id"], group["_id"]["checkpoint_ns"])
+            checkpoints, writes, reclaimed = checkpoints + c, writes + w, reclaimed + b
+        archived = 0
+        update = {"last_run": started}
+        if CHECKPOINT_ARCHIVE_AFTER_DAYS:
+            archived, archived_bytes, update["archive_cutoff"] = await self.archive_idle(
+                timedelta(days=CHECKPOINT_ARCHIVE_AFTER_DAYS), state.get("archive_cutoff"))
+            reclaimed += archived_bytes
+        await self.compaction_state.update_one({"_id": "state"}, {"$set": update}, upsert=True)
+        self.report.update(
+            runs=self.report["runs"] + 1,
+            checkpoints_deleted=self.report["checkpoints_deleted"] + checkpoints,
+            writes_deleted=self.report["writes_deleted"] + writes,
+            threads_archived=self.report["threads_archived"] + archived,
+            bytes_reclaimed=self.report["bytes_reclaimed"] + reclaimed,
+            last_run={"at": started.isoformat(), "checkpoints_deleted": checkpoints, "writes_deleted": writes,
+                      "threads_archived": archived, "bytes_reclaimed": reclaimed},
+        )
+        logger.info("checkpoint compaction: %s checkpoints, %s writes deleted, %s threads archived, %s bytes reclaimed",
+                    checkpoints, writes, archived, reclaimed)
+        return self.report["last_run"]
+
+    async def run_compaction(self, interval: float = CHECKPOINT_COMPACTION_INTERVAL):
+        while True:
+            try:
+                await self.compact()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("checkpoint compaction failed")
+            await asyncio.sleep(interval)
@@ -0,0 +1,248 @@
+# %%
+"""Doctors of a specialty at given hospitals, without a model in the loop.
+
+One precompiled, parameterized Cypher query answers every hospital of a lookup in a
+single round trip (UNWIND over the hospital keys), instead of GraphCypherQAChain
+writing Cypher and phrasing the answer with two model calls. The graph is
+
+    (:Doctor {name, hospital_key, specialty, specialty_key, slots})-[:WORKS_AT]->(:Hospital {name, name_key})
+
+with indexes on Doctor.specialty_key, Doctor (name, hospital_key) and Hospital.name_key
+(`setup` creates them and fills the keys of existing nodes). A doctor is one node per
+hospital, two doctors of the same name at different hospitals never merge. Answers are cached per (specialty, hospital) for
+DOCTOR_CACHE_TTL, so overlapping hospital lists only query what is missing.
+
+DOCTOR_BACKEND=neo4j uses NEO4J_URI / NEO4J_USERNAME / NEO4J_PASSWORD, `memory` an in
+process stand-in loaded from DOCTOR_SEED_PATH (the same json `seed` loads into neo4j):
+
+    python doctor_lookup.py seed doctors.json
+"""
+import json
+import os
+import sys
+import threading
+from embedding_cache import disk_lru_cache
+
+NEO4J_URI = os.getenv("NEO4J_URI", "")
+NEO4J_USERNAME = os.getenv("NEO4J_USERNAME", "neo4j")
+NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "")
+NEO4J_DATABASE = os.getenv("NEO4J_DATABASE", "neo4j")
+DOCTOR_SEED_PATH = os.getenv("DOCTOR_SEED_PATH", "doctors.json")
+DOCTOR_BACKEND = os.getenv("DOCTOR_BACKEND", "neo4j" if NEO4J_URI else "memory")
+DOCTORS_PER_HOSPITAL = int(os.getenv("DOCTORS_PER_HOSPITAL", "5"))
+
+# (specialty, hospital) -> doctors, short lived so roster and slot changes show up
+doctor_cache = disk_lru_cache("doctor_lookups", ttl=float(os.getenv("DOCTOR_CACHE_TTL", "600")),
+                              max_items=20000, max_memory=2048)
+
+SETUP = [
+    "CREATE INDEX doctor_specialty_key IF NOT EXISTS FOR (d:Doctor) ON (d.specialty_key)",
+    "CREATE INDEX doctor_name_hospital IF NOT EXISTS FOR (d:Doctor) ON (d.name, d.hospital_key)",
+    "CREATE INDEX hospital_name_key IF NOT EXISTS FOR (h:Hospital) ON (h.name_key)",
+    # nodes written before the keys existed
+    "MATCH (d:Doctor) WHERE d.specialty_key IS NULL AND d.specialty IS NOT NULL "
+    "SET d.specialty_key = toLower(trim(d.specialty))",
+    "MATCH (h:Hospital) WHERE h.name_key IS NULL AND h.name IS NOT NULL SET h.name_key = toLower(trim(h.name))",
+    "MATCH (d:Doctor)-[:WORKS_AT]->(h:Hospital) WHERE d.hospital_key IS NULL SET d.hospital_key = h.name_key",
+]
+
+FIND_DOCTORS = """
+UNWIND $hospitals AS hospital_key
+MATCH (h:Hospital {name_key: hospital_key})<-[:WORKS_AT]-(d:Doctor {specialty_key: $specialty})
+WITH hospital_key, h, d ORDER BY d.name
+RETURN hospital_key, h.name AS hospital, collect(d {.name, .slots})[..$limit] AS doctors
+"""
+
+DOCTOR_SLOTS = """
+MATCH (h:Hospital {name_key: $hospital})<-[:WORKS_AT]-(d:Doctor)
+WHERE toLower(trim(d.name)) = $name
+RETURN d.slots AS slots LIMIT 1
+"""
+
+SEED = """
+UNWIND $rows AS row
+MERGE (h:Hospital {name_key: row.hospital_key}) ON CREATE SET h.name = row.hospital
+MERGE (d:Doctor {name: row.name, hospital_key: row.hospital_key})
+SET d.specialty = row.specialty, d.specialty_key = row.specialty_key, d.slots = row.slots
+MERGE (d)-[:WORKS_AT]->(h)
+"""
+
+
+def key(text: str) -> str:
+    # same as toLower(trim(..)) in the SETUP queries
+    return str(text).strip().lower()
+
+
+def seed_rows(doctors: list[dict]) -> list[dict]:
+    """seed file records ({name, specialty, hospital, slots}) with their keys"""
+    return [dict(name=d["name"], specialty=d["specialty"], specialty_key=key(d["specialty"]),
+                 hospital=d["hospital"], hospital_key=key(d["hospital"]), slots=d.get("slots", ""))
+            for d in doctors]
+
+
+# %%
+class neo4j_doctors:
+    def __init__(self, uri: str = NEO4J_URI, username: str = NEO4J_USERNAME, password: str = NEO4J_PASSWORD,
+                 database: str = NEO4J_DATABASE):
+        # imported here, a deployment on the memory backend does not need the driver
+        from neo4j import GraphDatabase
+
+        self.driver = GraphDatabase.driver(uri, auth=(username, password))
+        self.database = database
+
+    def setup(self):
+        for query in SETUP:
+            self.driver.execute_query(query, database_=self.database)
+
+    def seed(self, doctors: list[dict]):
+        self.driver.execute_query(SEED, {"rows": seed_rows(doctors)}, database_=self.database)
+
+    def find(self, specialty: str, hospitals: list[str], limit: int) -> dict[str, dict]:
+        """hospital key -> {hospital, doctors} for the hospitals that have such doctors"""
+        from neo4j import RoutingControl
+
+        records, _, _ = self.driver.execute_query(
+            FIND_DOCTORS, {"specialty": specialty, "hospitals": hospitals, "limit": limit},
+            database_=self.database, routing_=RoutingControl.READ)
+        return {r["hospital_key"]: {"hospital": r["hospital"], "doctors": r["doctors"]} for r in records}
+
+    def slots(self, name: str, hospital: str):
+        from neo4j import RoutingControl
+
+        records, _, _ = self.driver.execute_query(
+            DOCTOR_SLOTS, {"name": name, "hospital": hospital}, database_=self.database, routing_=RoutingControl.READ)
+        return records[0]["slots"] if records else None
+
+    def close(self):
+        self.driver.close()
+
+
+class memory_doctors:
+    """the same graph in dicts, for local runs and benchmarks without a neo4j"""
+
+    def __init__(self):
+        # (specialty key, hospital key) -> doctors, the two indexes in one
+        self.doctors: dict[tuple[str, str], list[dict]] = {}
+        self.hospitals: dict[str, str] = {}
+        # (hospital key, name key) -> slots
+        self.schedules: dict[tuple[str, str], str] = {}
+
+    def setup(self):
+        pass
+
+    def seed(self, doctors: list[dict]):
+        for row in seed_rows(doctors):
+            self.hospitals.setdefault(row["hospital_key"], row["hospital"])
+            at = self.doctors.setdefault((row["specialty_key"], row["hospital_key"]), [])
+            at[:] = [d for d in at if d["name"] != row["name"]] + [{"name": row["name"], "slots": row["slots"]}]
+            at.sort(key=lambda d: d["name"])
+            self.schedules[(row["hospital_key"], key(row["name"]))] = row["slots"]
+
+    def find(self, specialty: str, hospitals: list[str], limit: int) -> dict[str, dict]:
+        found = {}
+        for hospital in hospitals:
+            doctors = self.doctors.get((specialty, hospital))
+            if doctors:
+                found[hospital] = {"hospital": self.hospitals[hospital], "doctors": doctors[:limit]}
+        return found
+
+    def slots(self, name: str, hospital: str):
+        return self.schedules.get((hospital, name))
+
+    def close(self):
+        pass
+
+    @classmethod
+    def load(cls, path: str = DOCTOR_SEED_PATH):
+        doctors = cls()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                doctors.seed(json.load(f))
+        return doctors
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    """the configured doctor graph, None when there is none (no neo4j, no seed file)"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if DOCTOR_BACKEND == "neo4j":
+                _backend = neo4j_doctors()
+                _backend.setup()
+            else:
+                _backend = memory_doctors.load()
+        if isinstance(_backend, memory_doctors) and not _backend.doctors:
+            return None
+        return _backend
+
+
+def close():
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+            _backend = None
+
+
+# %%
+def find_doctors(doctor_field: str, hospital_names: list[str], limit: int = DOCTORS_PER_HOSPITAL):
+    """{"doctors": [{hospital, name, slots}], "no_doctors_at": [...]}, None without a backend.
+    Only the hospitals that are not cached for this specialty are queried, all in one go"""
+    graph = backend()
+    if graph is None:
+        return None
+    specialty = key(doctor_field)
+    names = {}
+    for name in hospital_names:
+        if str(name).strip():
+            names.setdefault(key(name), str(name).strip())
+    hospitals = list(names)
+    answers, missing = {}, []
+    for hospital in hospitals:
+        cached = doctor_cache.get(f"{specialty}|{hospital}")
+        if cached is None:
+            missing.append(hospital)
+        else:
+            answers[hospital] = cached
+    if missing:
+        found = graph.find(specialty, missing, limit)
+        for hospital in missing:
+            # a hospital without such doctors is cached too, as an empty answer
+            answers[hospital] = found.get(hospital, {"hospital": names[hospital], "doctors": []})
+            doctor_cache.put(f"{specialty}|{hospital}", answers[hospital])
+    doctors = [dict(doctor, hospital=answers[h]["hospital"]) for h in hospitals for doctor in answers[h]["doctors"]]
+    return {"doctors": doctors,
+            "no_doctors_at": [answers[h]["hospital"] for h in hospitals if not answers[h]["doctors"]]}
+
+
+def doctor_slots(doctor: str, hospital: str):
+    """the slots text of a doctor at a hospital ("9 am to 12 pm and 4 pm to 7 pm"), None when
+    the doctor is not in the graph or there is no graph"""
+    graph = backend()
+    if graph is None:
+        return None
+    cache_key = f"slots|{key(hospital)}|{key(doctor)}"
+    cached = doctor_cache.get(cache_key)
+    if cached is None:
+        # "" caches a doctor the graph does not know
+        cached = graph.slots(key(doctor), key(hospital)) or ""
+        doctor_cache.put(cache_key, cached)
+    return cached or None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "seed":
+        raise SystemExit("python doctor_lookup.py seed doctors.json")
+    if DOCTOR_BACKEND != "neo4j":
+        raise SystemExit("the memory backend reads DOCTOR_SEED_PATH itself, set NEO4J_URI to seed a neo4j")
+    with open(sys.argv[2], encoding="utf-8") as f:
+        rows = json.load(f)
+    graph = neo4j_doctors()
+    graph.setup()
+    graph.seed(rows)
+    graph.close()
+    print(f"{len(rows)} doctors seeded into {NEO4J_URI}")
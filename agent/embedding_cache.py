@@ -0,0 +1,105 @@
+# %%
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+RETRIEVAL_CACHE_PATH = os.getenv("RETRIEVAL_CACHE_PATH", "retrieval_cache.sqlite3")
+
+
+def normalize_query(query: str) -> str:
+    """queries that only differ in case, spacing or trailing punctuation share one cache entry"""
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = re.sub(r"\s+", " ", query)
+    return query.strip(" \t\n.,;:!?\"'")
+
+
+def embedding_key(embedding: list[float], k: int) -> str:
+    return hashlib.sha1(array("f", embedding).tobytes()).hexdigest() + f":{k}"
+
+
+# %%
+class disk_lru_cache:
+    """LRU/TTL mapping held in memory and written through to a sqlite table,
+    so entries survive a restart. The memory level holds at most `max_memory`
+    items, the table at most `max_items`; both drop entries older than `ttl` seconds."""
+
+    def __init__(self, table: str, ttl: float, max_items: int = 50000, max_memory: int = 2048,
+                 path: str = RETRIEVAL_CACHE_PATH):
+        self.table = table
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_memory = max_memory
+        self.memory: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                        "(key TEXT PRIMARY KEY, value BLOB, created REAL, used REAL)")
+        self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_used ON {table} (used)")
+        self.writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            item = self.memory.get(key)
+            if item is not None and item[0] + self.ttl > now:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            row = self.db.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] + self.ttl <= now:
+                self.memory.pop(key, None)
+                self.misses += 1
+                return None
+            value = pickle.loads(row[0])
+            self.db.execute(f"UPDATE {self.table} SET used = ? WHERE key = ?", (now, key))
+            self.remember(key, row[1], value)
+            self.disk_hits += 1
+            return value
+
+    def put(self, key: str, value):
+        now = time.time()
+        with self.lock:
+            self.remember(key, now, value)
+            self.db.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+                            (key, pickle.dumps(value), now, now))
+            self.writes += 1
+            if self.writes % 500 == 0:
+                self.prune(now)
+
+    def remember(self, key, created, value):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def prune(self, now):
+        self.db.execute(f"DELETE FROM {self.table} WHERE created <= ?", (now - self.ttl,))
+        self.db.execute(f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+                        "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_items,))
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+            "memory_entries": len(self.memory),
+        }
+
+
+# normalized query text -> embedding vector, the embedding model does not change under us
+query_embeddings = disk_lru_cache("query_embeddings", ttl=float(os.getenv("EMBEDDING_CACHE_TTL", str(30 * 86400))))
+# embedding -> top k documents, shorter lived so corpus updates show up
+retrieved_documents = disk_lru_cache("retrieved_documents", ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", str(86400))))
@@ -1,7 +1,3 @@
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
-from pymongo import MongoClient
-from langchain_mongodb import MongoDBAtlasVectorSearch
-import os
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -13,8 +9,8 @@ load_dotenv()
 
 
 
-MONGODB_ATLAS_CLUSTER_URI = os.environ["MONGOURI"]
-client = MongoClient(MONGODB_ATLAS_CLUSTER_URI)
+from resources import mongo
+client = mongo()
 
 DB_NAME = "test"
 COLLECTION_NAME = "vectorsearches"
@@ -1,17 +1,15 @@
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
 from langchain_google_genai.embeddings import GoogleGenerativeAIEmbeddings
-from pymongo import MongoClient
-from langchain_mongodb import MongoDBAtlasVectorSearch
 import os
 from dotenv import load_dotenv
+from embedding_cache import normalize_query, embedding_key, query_embeddings, retrieved_documents
+from resources import mongo
 load_dotenv()
 
 embedding_model = GoogleGenerativeAIEmbeddings(model="gemini-embedding-001")
 
 
 
-MONGODB_ATLAS_CLUSTER_URI = os.environ["MONGOURI"]
-client = MongoClient(MONGODB_ATLAS_CLUSTER_URI)
+client = mongo()
 
 DB_NAME = "test"
 COLLECTION_NAME = "vectorsearches"
@@ -19,22 +17,46 @@ ATLAS_VECTOR_SEARCH_INDEX_NAME = "vector_index"
 
 MONGODB_COLLECTION = client[DB_NAME][COLLECTION_NAME]
 
-vector_store = MongoDBAtlasVectorSearch(
-    collection=MONGODB_COLLECTION,
-    embedding=embedding_model,
-    index_name=ATLAS_VECTOR_SEARCH_INDEX_NAME,
-    relevance_score_fn="cosine",
-)
-retriver = vector_store.as_retriever(
-        search_kwargs={'k': 5}
-)
+# atlas: $vectorSearch on the cluster, exact / ivf: in-process index exported with `python vector_index.py export`
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "atlas")
+
+if VECTOR_BACKEND == "atlas":
+    from langchain_mongodb import MongoDBAtlasVectorSearch
+    vector_store = MongoDBAtlasVectorSearch(
+        collection=MONGODB_COLLECTION,
+        embedding=embedding_model,
+        index_name=ATLAS_VECTOR_SEARCH_INDEX_NAME,
+        relevance_score_fn="cosine",
+    )
+else:
+    from vector_index import local_vector_index
+    vector_store = local_vector_index.load(mode=VECTOR_BACKEND)
+
+TOP_K = 5
+
+
+def search_by_vector(embedding: list[float]):
+    if VECTOR_BACKEND == "atlas":
+        # MongoDBAtlasVectorSearch has no public search by vector (similarity_search_by_vector
+        # is the VectorStore stub that raises), its private score search runs the $vectorSearch
+        # pipeline on a vector we already have. langchain-mongodb is pinned (0.6.2) for this,
+        # check the signature before upgrading it
+        return [doc for doc, _ in vector_store._similarity_search_with_score(embedding, k=TOP_K)]
+    return vector_store.similarity_search_by_vector(embedding, k=TOP_K)
 
 
 def disease_data_search_from_database(query: str):
-    results = retriver.invoke(query)
+    # two cache levels: normalized text -> embedding skips the gemini embedding call,
+    # embedding -> documents skips the atlas $vectorSearch
+    key = normalize_query(query)
+    embedding = query_embeddings.get(key)
+    if embedding is None:
+        embedding = embedding_model.embed_query(key)
+        query_embeddings.put(key, embedding)
+    doc_key = embedding_key(embedding, TOP_K) + f":{VECTOR_BACKEND}"
+    results = retrieved_documents.get(doc_key)
+    if results is None:
+        results = search_by_vector(embedding)
+        retrieved_documents.put(doc_key, results)
     out = "\n".join(result.page_content for result in results)
     return out
-
-    
-    
-
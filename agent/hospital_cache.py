@@ -0,0 +1,185 @@
+# %%
+import json
+import math
+import os
+import time
+
+EARTH_RADIUS = 6371000  # metres
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """great circle distance between two points in metres"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+LAT_KEYS = ("lat", "latitude", "y")
+LON_KEYS = ("lon", "long", "lng", "longitude", "x")
+
+
+def hospital_location(hospital: dict):
+    """(lat, lon) of a bhuvan hospital record or None when it has no usable coordinates"""
+    lat = next((hospital[k] for k in LAT_KEYS if hospital.get(k) not in (None, "")), None)
+    lon = next((hospital[k] for k in LON_KEYS if hospital.get(k) not in (None, "")), None)
+    try:
+        return float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+
+
+NAME_KEYS = ("hospital_name", "name", "hos_name", "hname", "facility_name")
+PHONE_KEYS = ("contact_number", "phone", "phone_no", "telephone", "tel", "mobile", "contact")
+# hospitals of the same name closer than this are one hospital listed twice
+DUPLICATE_METRES = 250
+# approx tokens (chars/3, as tokens.approx_tokens) the hospital list of a tool answer may take
+HOSPITAL_RESULT_TOKENS = int(os.getenv("HOSPITAL_RESULT_TOKENS", "400"))
+
+
+def first_field(hospital: dict, keys, contains: tuple[tuple[str, ...], ...]):
+    """the first of the known keys, else a key that has every part of one of `contains`"""
+    value = next((hospital[k] for k in keys if hospital.get(k) not in (None, "")), None)
+    if value is None:
+        value = next((v for k, v in hospital.items()
+                      if v not in (None, "") and any(all(c in k.lower() for c in parts) for parts in contains)), None)
+    return " ".join(str(value).split()) if value is not None else None
+
+
+def compact_hospitals(nearest, k: int, max_tokens: int = HOSPITAL_RESULT_TOKENS, total: int | None = None) -> dict:
+    """the k closest of the (distance, hospital) pairs as small records (name, distance,
+    phone, lat/lon), without duplicates and within max_tokens. `nearest` may be the closest
+    few of `total` hospitals in reach. `omitted` counts the hospitals in reach that were left
+    out (beyond k or over the budget), duplicates among `nearest` not included"""
+    records, kept = [], []
+    duplicates = 0
+    for distance, hospital in nearest:
+        name = first_field(hospital, NAME_KEYS, (("hosp", "name"), ("facilit", "name"))) or "unnamed hospital"
+        location = hospital_location(hospital)
+        key = "".join(ch for ch in name.lower() if ch.isalnum())
+        if any(key == other and haversine(*location, *at) < DUPLICATE_METRES for other, at in kept):
+            duplicates += 1
+            continue
+        kept.append((key, location))
+        record = {"name": name, "distance_m": round(distance)}
+        phone = first_field(hospital, PHONE_KEYS, (("phone",), ("contact",), ("mobile",)))
+        if phone:
+            record["phone"] = phone
+        record["lat"], record["lon"] = round(location[0], 5), round(location[1], 5)
+        records.append(record)
+    shown, chars = [], 0
+    for record in records[:k]:
+        chars += len(json.dumps(record, ensure_ascii=False)) + 2
+        if shown and chars / 3 > max_tokens:
+            break
+        shown.append(record)
+    # hospitals in reach beyond the candidates were never looked at
+    unseen = max(0, total - len(nearest)) if total is not None else 0
+    return {"hospitals": shown, "omitted": len(records) - len(shown) + unseen}
+
+
+def parse_hospitals(content: bytes):
+    """bhuvan answers `false ` when the buffer holds no hospital and a json list otherwise.
+    Returns the list of hospital records, or None if the body could not be understood"""
+    text = content.decode("utf-8", errors="ignore").strip()
+    if text in ("", "false"):
+        return []
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if isinstance(data, dict):
+        data = next((v for v in data.values() if isinstance(v, list)), [data])
+    if not isinstance(data, list):
+        return None
+    return [h for h in data if isinstance(h, dict)]
+
+
+# %%
+class geo_entry:
+    __slots__ = ("lat", "lon", "radius", "hospitals", "expires")
+
+    def __init__(self, lat, lon, radius, hospitals, expires):
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+        self.hospitals = hospitals
+        self.expires = expires
+
+    def covers(self, lat, lon, radius):
+        # the query circle lies completely inside the cached one
+        return haversine(self.lat, self.lon, lat, lon) + radius <= self.radius
+
+
+class geo_cache:
+    """Proximity results keyed by a lat/lon grid cell.
+
+    An entry remembers the circle it was fetched for, so a later query whose circle
+    lies inside it (same point with a smaller radius, or a nearby point) is answered
+    by filtering the cached hospitals on distance instead of calling bhuvan again.
+    """
+
+    def __init__(self, cell_size: float = 0.05, ttl: float = 6 * 3600, max_entries: int = 4096):
+        self.cell_size = cell_size  # degrees, ~5.5 km of latitude
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cells: dict[tuple[int, int], list[geo_entry]] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def neighbours(self, lat, lon):
+        i, j = self.cell(lat, lon)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                yield i + di, j + dj
+
+    def get(self, lat: float, lon: float, radius: float):
+        now = time.monotonic()
+        for key in self.neighbours(lat, lon):
+            for entry in self.cells.get(key, ()):
+                if entry.expires > now and entry.covers(lat, lon, radius):
+                    self.hits += 1
+                    return [h for h in entry.hospitals
+                            if (loc := hospital_location(h)) and haversine(lat, lon, *loc) <= radius]
+        self.misses += 1
+        return None
+
+    def put(self, lat: float, lon: float, radius: float, hospitals: list[dict]):
+        now = time.monotonic()
+        entry = geo_entry(lat, lon, radius, hospitals, now + self.ttl)
+        key = self.cell(lat, lon)
+        # drop what expired or what the new circle makes redundant
+        kept = [e for e in self.cells.get(key, ()) if e.expires > now and not entry.covers(e.lat, e.lon, e.radius)]
+        self.size += len(kept) + 1 - len(self.cells.get(key, ()))
+        self.cells[key] = kept + [entry]
+        if self.size > self.max_entries:
+            self.evict(now)
+
+    def evict(self, now):
+        for key in list(self.cells):
+            self.cells[key] = [e for e in self.cells[key] if e.expires > now]
+        entries = sorted((e.expires, key, id(e)) for key, es in self.cells.items() for e in es)
+        drop = {i for _, _, i in entries[:max(0, len(entries) - self.max_entries)]}
+        for key in list(self.cells):
+            self.cells[key] = [e for e in self.cells[key] if id(e) not in drop]
+            if not self.cells[key]:
+                del self.cells[key]
+        self.size = sum(len(es) for es in self.cells.values())
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.size,
+        }
+
+
+hospital_cache = geo_cache(
+    cell_size=float(os.getenv("HOSPITAL_CACHE_CELL", "0.05")),
+    ttl=float(os.getenv("HOSPITAL_CACHE_TTL", str(6 * 3600))),
+)
@@ -0,0 +1,145 @@
+# %%
+import json
+import os
+import sys
+import threading
+from hospital_cache import EARTH_RADIUS, haversine, hospital_location, parse_hospitals
+
+HOSPITAL_INDEX_PATH = os.getenv("HOSPITAL_INDEX_PATH", "hospital_index.json")
+
+
+# %%
+class hospital_index:
+    """Nearest hospital lookups over a haversine ball tree.
+
+    Records come from a seeded dataset / bhuvan export on disk and from every
+    bhuvan answer the agent receives, so the tree fills up with the areas users
+    actually ask about. The tree is rebuilt lazily on the next query after new
+    records were added.
+
+    The tree only knows the hospitals of the circles bhuvan was asked for, so it
+    also keeps those circles: a query is only answered from the tree when its circle
+    lies inside one of them (or the seeded data was marked complete), anywhere else
+    hospitals closer than the ones in the tree may never have been fetched.
+    """
+
+    def __init__(self, path: str = HOSPITAL_INDEX_PATH):
+        self.path = path
+        self.hospitals: list[dict] = []
+        self.locations: list[tuple[float, float]] = []
+        self.keys: set = set()
+        self.tree = None
+        self.dirty = False
+        # (lat, lon, radius in metres) of every bhuvan answer that went into the index
+        self.covered: list[tuple[float, float, float]] = []
+        self.complete = False
+        self.save_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hospitals)
+
+    def key(self, hospital, location):
+        name = str(next((v for k, v in hospital.items() if "name" in k.lower()), "")).strip().lower()
+        return name, round(location[0], 5), round(location[1], 5)
+
+    def add(self, hospitals: list[dict]) -> int:
+        added = 0
+        for hospital in hospitals:
+            location = hospital_location(hospital)
+            if location is None:
+                continue
+            key = self.key(hospital, location)
+            if key in self.keys:
+                continue
+            self.keys.add(key)
+            self.hospitals.append(hospital)
+            self.locations.append(location)
+            added += 1
+        if added:
+            self.dirty = True
+        return added
+
+    def covers(self, lat: float, lon: float, radius: float) -> bool:
+        return self.complete or any(haversine(c_lat, c_lon, lat, lon) + radius <= c_radius
+                                    for c_lat, c_lon, c_radius in self.covered)
+
+    def cover(self, lat: float, lon: float, radius: float) -> bool:
+        """remember that bhuvan's answer for this circle is in the index, False if it adds nothing"""
+        if self.covers(lat, lon, radius):
+            return False
+        # circles inside the new one are redundant
+        self.covered = [(c_lat, c_lon, c_radius) for c_lat, c_lon, c_radius in self.covered
+                        if haversine(lat, lon, c_lat, c_lon) + c_radius > radius] + [(lat, lon, radius)]
+        return True
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                content = f.read()
+            self.add(parse_hospitals(content) or [])
+            try:
+                data = json.loads(content)
+            except ValueError:
+                data = None
+            # files written before coverage was kept are a plain list and cover nothing
+            if isinstance(data, dict):
+                self.covered = [tuple(c) for c in data.get("covered", [])]
+                self.complete = bool(data.get("complete", False))
+        return self
+
+    def save(self):
+        with self.save_lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"hospitals": self.hospitals, "covered": self.covered, "complete": self.complete},
+                          f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+    def build(self):
+        # imported here so the service does not pay for sklearn until the first lookup
+        import numpy as np
+        from sklearn.neighbors import BallTree
+
+        self.tree = BallTree(np.radians(np.asarray(self.locations, dtype=np.float64)), metric="haversine")
+        self.dirty = False
+
+    def nearest(self, lat: float, lon: float, k: int = 5, max_distance: float = 10000):
+        """up to k (distance in metres, hospital) pairs within max_distance, closest first"""
+        if not self.hospitals or k <= 0:
+            return []
+        if self.tree is None or self.dirty:
+            self.build()
+        import numpy as np
+
+        distances, indices = self.tree.query(np.radians([[lat, lon]]), k=min(k, len(self.hospitals)))
+        return [(float(d) * EARTH_RADIUS, self.hospitals[i])
+                for d, i in zip(distances[0], indices[0]) if d * EARTH_RADIUS <= max_distance]
+
+    def count(self, lat: float, lon: float, max_distance: float = 10000) -> int:
+        """hospitals within max_distance"""
+        if not self.hospitals:
+            return 0
+        if self.tree is None or self.dirty:
+            self.build()
+        import numpy as np
+
+        return int(self.tree.query_radius(np.radians([[lat, lon]]), r=max_distance / EARTH_RADIUS, count_only=True)[0])
+
+
+hospitals_index = hospital_index().load()
+
+
+# %%
+if __name__ == "__main__":
+    # merge bhuvan exports / seed files into the index file:
+    #   python hospital_index.py export1.json export2.json
+    # --complete when the files hold every hospital of the area the service runs in,
+    # the index then answers every query without asking bhuvan
+    paths = [a for a in sys.argv[1:] if a != "--complete"]
+    if "--complete" in sys.argv[1:]:
+        hospitals_index.complete = True
+    for path in paths:
+        with open(path, "rb") as f:
+            print(f"{path}: {hospitals_index.add(parse_hospitals(f.read()) or [])} new hospitals")
+    hospitals_index.save()
+    print(f"{len(hospitals_index)} hospitals in {hospitals_index.path}")
@@ -0,0 +1,149 @@
+# %%
+"""Prometheus metrics of the agent service, served on /metrics.
+
+Nothing in the graph is edited by hand: `instrument_graph` binds a callback handler to
+the compiled graph that times every node, tool and model call from the callback events
+langgraph already emits, and `instrument_checkpointer` wraps the saver's I/O methods.
+The api adds the stream level metrics (active streams, time to first token, errors).
+"""
+import functools
+import time
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40)
+
+NODE_SECONDS = Histogram("agent_node_seconds", "graph node latency", ["node"], buckets=LATENCY_BUCKETS)
+NODE_ERRORS = Counter("agent_node_errors_total", "graph node failures", ["node"])
+TOOL_SECONDS = Histogram("agent_tool_seconds", "tool latency", ["tool"], buckets=LATENCY_BUCKETS)
+TOOL_ERRORS = Counter("agent_tool_errors_total", "tool failures", ["tool"])
+LLM_SECONDS = Histogram("agent_llm_seconds", "model call latency", ["model"], buckets=LATENCY_BUCKETS)
+LLM_TOKENS = Counter("agent_llm_tokens_total", "tokens reported by the model", ["model", "kind"])
+LLM_ERRORS = Counter("agent_llm_errors_total", "failed model calls", ["model"])
+TOOL_LOOP = Histogram("agent_tool_loop_iterations", "chat_node runs per turn (1 + tool rounds)",
+                      buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15))
+HISTORY_LOOP = Histogram("agent_history_iterations", "history (summarize and evict) runs per turn",
+                         buckets=(0, 1, 2, 3, 5))
+CHECKPOINT_SECONDS = Histogram("agent_checkpoint_seconds", "checkpointer I/O latency", ["op"],
+                               buckets=LATENCY_BUCKETS)
+CHECKPOINT_ERRORS = Counter("agent_checkpoint_errors_total", "checkpointer I/O failures", ["op"])
+ACTIVE_STREAMS = Gauge("agent_active_streams", "turns streaming right now")
+FIRST_TOKEN_SECONDS = Histogram("agent_time_to_first_token_seconds", "turn start to the first SSE token",
+                                buckets=LATENCY_BUCKETS)
+TURN_SECONDS = Histogram("agent_turn_seconds", "whole turn latency", buckets=LATENCY_BUCKETS)
+STREAM_ERRORS = Counter("agent_stream_errors_total", "turns that ended with an error event", ["error"])
+
+
+# %%
+class metrics_handler(BaseCallbackHandler):
+    """times graph nodes, tools and model calls from langchain callback events"""
+
+    # plain dict and prometheus updates, no need to hop to an executor thread
+    run_inline = True
+
+    def __init__(self):
+        self.started: dict = {}
+        self.loops: dict = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        if parent_run_id is None:
+            self.loops[run_id] = {"chat_node": 0, "history": 0}
+        elif node is not None and kwargs.get("name") == node:
+            self.started[run_id] = ("node", node, time.perf_counter())
+            if node in ("chat_node", "history") and parent_run_id in self.loops:
+                self.loops[parent_run_id][node] += 1
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        if run_id in self.loops:
+            runs = self.loops.pop(run_id)
+            TOOL_LOOP.observe(runs["chat_node"])
+            HISTORY_LOOP.observe(runs["history"])
+        self.finish(run_id, error=False)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.loops.pop(run_id, None)
+        self.finish(run_id, error=True)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name", "unknown")
+        self.started[run_id] = ("tool", name, time.perf_counter())
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self.finish(run_id, error=False)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self.finish(run_id, error=True)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        model = (metadata or {}).get("ls_model_name") or "unknown"
+        self.started[run_id] = ("llm", model, time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        entry = self.started.get(run_id)
+        if entry is not None:
+            for generations in response.generations:
+                for generation in generations:
+                    usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    if usage:
+                        LLM_TOKENS.labels(entry[1], "input").inc(usage.get("input_tokens", 0))
+                        LLM_TOKENS.labels(entry[1], "output").inc(usage.get("output_tokens", 0))
+        self.finish(run_id, error=False)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.finish(run_id, error=True)
+
+    def finish(self, run_id, error: bool):
+        entry = self.started.pop(run_id, None)
+        if entry is None:
+            return
+        kind, name, started = entry
+        seconds = time.perf_counter() - started
+        if kind == "node":
+            (NODE_ERRORS.labels(name).inc() if error else NODE_SECONDS.labels(name).observe(seconds))
+        elif kind == "tool":
+            (TOOL_ERRORS.labels(name).inc() if error else TOOL_SECONDS.labels(name).observe(seconds))
+        else:
+            (LLM_ERRORS.labels(name).inc() if error else LLM_SECONDS.labels(name).observe(seconds))
+
+
+def instrument_graph(graph):
+    """the compiled graph with the metrics handler bound to every run"""
+    return graph.with_config(callbacks=[metrics_handler()])
+
+
+# %%
+CHECKPOINT_OPS = ("aget_tuple", "aput", "aput_writes", "flush")
+
+
+def instrument_checkpointer(saver):
+    """time the I/O methods of a saver instance in place"""
+    for op in CHECKPOINT_OPS:
+        method = getattr(saver, op, None)
+        if method is None:
+            continue
+
+        @functools.wraps(method)
+        async def timed(*args, _method=method, _op=op, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await _method(*args, **kwargs)
+            except Exception:
+                CHECKPOINT_ERRORS.labels(_op).inc()
+                raise
+            finally:
+                CHECKPOINT_SECONDS.labels(_op).observe(time.perf_counter() - started)
+
+        setattr(saver, op, timed)
+    return saver
+
+
+def gauge_from(name: str, description: str, read):
+    """gauge read at scrape time, for queue depths and pool usage kept elsewhere"""
+    gauge = Gauge(name, description)
+    gauge.set_function(read)
+    return gauge
+
+
+def latest():
+    return generate_latest(), CONTENT_TYPE_LATEST
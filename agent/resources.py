@@ -0,0 +1,222 @@
+# %%
+"""Connections of the agent service, one pool of each kind for the whole process.
+
+- mongo: a single motor client. The checkpointer uses it directly, sync code (bookings,
+  vector search) uses its pymongo delegate, so both share one connection pool.
+- http: an httpx.AsyncClient for the async tools and a requests.Session for the sync
+  ones, both keep connections to bhuvan and the other apis alive between calls.
+
+Nothing is opened at import time: the api lifespan opens them before the first request
+and closes them on shutdown, scripts and benchmarks get them on first use."""
+import os
+import threading
+import httpx
+import requests
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.monitoring import ConnectionPoolListener
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "2"))
+MONGO_MAX_IDLE_MS = int(os.getenv("MONGO_MAX_IDLE_MS", "300000"))
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", "5000"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+
+
+# %%
+class pool_listener(ConnectionPoolListener):
+    """counts what the mongo connection pool does, for /pool_stats"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.created = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds = 0.0
+        self.cleared = 0
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open += 1
+            self.created += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open -= 1
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.checkouts += 1
+            self.wait_seconds += getattr(event, "duration", 0.0)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.checkout_failures += 1
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.cleared += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def stats(self, max_pool_size: int):
+        return {
+            "max_pool_size": max_pool_size,
+            "open": self.open,
+            "in_use": self.in_use,
+            "idle": self.open - self.in_use,
+            "utilization": self.in_use / max_pool_size if max_pool_size else 0.0,
+            "peak_in_use": self.peak_in_use,
+            "created": self.created,
+            "checkouts": self.checkouts,
+            "checkout_failures": self.checkout_failures,
+            "avg_wait_ms": self.wait_seconds / self.checkouts * 1e3 if self.checkouts else 0.0,
+            "cleared": self.cleared,
+        }
+
+
+mongo_pool = pool_listener()
+motor_client = None
+http_client = None
+http_session = None
+_lock = threading.Lock()
+
+
+# %%
+def motor() -> AsyncIOMotorClient:
+    global motor_client
+    with _lock:
+        if motor_client is None:
+            motor_client = AsyncIOMotorClient(
+                os.environ["MONGOURI"],
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_MS,
+                connectTimeoutMS=MONGO_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+                event_listeners=[mongo_pool],
+            )
+        return motor_client
+
+
+def mongo():
+    """the pymongo client behind the motor client, for sync code"""
+    return motor().delegate
+
+
+def http() -> httpx.AsyncClient:
+    global http_client
+    with _lock:
+        if http_client is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            )
+        return http_client
+
+
+def session() -> requests.Session:
+    global http_session
+    with _lock:
+        if http_session is None:
+            http_session = requests.Session()
+            # idempotent GETs are retried once on a dropped keep-alive connection or a 502/503/504
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_MAX_CONNECTIONS,
+                                  max_retries=Retry(total=1, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                                                    allowed_methods=frozenset({"GET"})))
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+        return http_session
+
+
+def timeout() -> tuple[float, float]:
+    """(connect, read) timeout for requests calls"""
+    return HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+
+def open_resources():
+    motor()
+    http()
+    session()
+
+
+async def close_resources():
+    global motor_client, http_client, http_session
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+    if http_session is not None:
+        http_session.close()
+        http_session = None
+    if motor_client is not None:
+        motor_client.close()
+        motor_client = None
+
+
+# %%
+def httpx_stats():
+    if http_client is None:
+        return None
+    # httpcore keeps its connections on the transport pool, there is no public accessor
+    connections = getattr(getattr(http_client._transport, "_pool", None), "connections", [])
+    idle = sum(1 for c in connections if c.is_idle())
+    return {"max_connections": HTTP_MAX_CONNECTIONS, "open": len(connections), "idle": idle,
+            "in_use": len(connections) - idle,
+            "utilization": (len(connections) - idle) / HTTP_MAX_CONNECTIONS}
+
+
+def session_stats():
+    if http_session is None:
+        return None
+    hosts = {}
+    for adapter in {id(a): a for a in http_session.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            idle = sum(1 for c in list(pool.pool.queue) if c is not None) if pool.pool else 0
+            hosts[f"{key.key_scheme}://{key.key_host}"] = {
+                "connections_made": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": idle,
+                "max_size": HTTP_MAX_CONNECTIONS,
+            }
+    return hosts
+
+
+def stats():
+    return {
+        "mongo": mongo_pool.stats(MONGO_MAX_POOL_SIZE) if motor_client is not None else None,
+        "httpx": httpx_stats(),
+        "requests": session_stats(),
+    }
@@ -0,0 +1,103 @@
+# %%
+"""Which model answers a turn.
+
+`fast` (FAST_MODEL) takes small talk and short follow-ups that need no tools, `full`
+(FULL_MODEL) everything medical, anything with numbers to compute and every booking
+flow. The decision is a local heuristic on the new user message, so routing costs no
+model call; summaries always go to the fast model.
+"""
+import os
+import re
+from langchain_core.messages import AIMessage, HumanMessage
+
+FULL_MODEL = os.getenv("FULL_MODEL", "gemini-2.5-flash")
+FAST_MODEL = os.getenv("FAST_MODEL", "gemini-2.5-flash-lite")
+ROUTING = os.getenv("ROUTING", "1") == "1"
+# messages up to this many words without any hint below count as simple follow-ups
+FOLLOW_UP_WORDS = int(os.getenv("ROUTER_FOLLOW_UP_WORDS", "6"))
+# usd per million input / output tokens, for the cost estimate of /route_stats
+PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+}
+
+SMALL_TALK = re.compile(
+    r"^(hi+|hello+|hey+|namaste|good (morning|afternoon|evening|night)|thanks?|thank you|thx|ok(ay)?|k|cool|great|"
+    r"nice|fine|got it|sure|yes|yeah|yep|no|nope|bye|goodbye|see you|welcome|sorry|alright|who are you|how are you)"
+    r"\b[\W\w]{0,20}$", re.I)
+FULL_HINTS = re.compile(
+    r"\b(book\w*|appointment\w*|cancel\w*|slots?|hospitals?|clinics?|doctors?|dr|near\w*|emergenc\w*|urgent\w*|pain\w*|"
+    r"fever|symptoms?|disease\w*|medicines?|tablets?|dos(e|age)\w*|mg|bmi|weigh\w*|kg|calculat\w*|search\w*|"
+    r"locat\w*|diagnos\w*|pregnan\w*|blood|heart|chest|breath\w*|allerg\w*|infection\w*|injur\w*|bleed\w*|"
+    r"cancer|diabet\w*|asthma|covid|flu|cough\w*|cold|headache|vomit\w*|rash\w*|treat\w*|sick\w*|ill)\b", re.I)
+
+
+def last_user_text(messages) -> str:
+    for m in reversed(messages):
+        if isinstance(m, HumanMessage):
+            return m.content if isinstance(m.content, str) else str(m.content)
+    return ""
+
+
+def in_tool_flow(messages) -> bool:
+    """the previous turn called tools, e.g. the user answers the booking question it ended with"""
+    humans = 0
+    for m in reversed(messages):
+        if isinstance(m, HumanMessage):
+            humans += 1
+            if humans == 2:
+                return False
+        elif humans == 1 and isinstance(m, AIMessage) and m.tool_calls:
+            return True
+    return False
+
+
+def classify(messages) -> tuple[str, str]:
+    """(route, reason) for the turn the last user message starts"""
+    if not ROUTING:
+        return "full", "routing off"
+    text = last_user_text(messages).strip()
+    if not text:
+        return "full", "no text"
+    if FULL_HINTS.search(text) or any(ch.isdigit() for ch in text):
+        return "full", "medical or tool hint"
+    if in_tool_flow(messages):
+        return "full", "tool flow"
+    if SMALL_TALK.match(text):
+        return "fast", "small talk"
+    if len(text.split()) <= FOLLOW_UP_WORDS:
+        return "fast", "short follow-up"
+    return "full", "default"
+
+
+# %%
+class route_recorder:
+    def __init__(self):
+        self.routes = {}
+        self.reasons = {}
+
+    def decided(self, route: str, reason: str):
+        self.reasons[f"{route}:{reason}"] = self.reasons.get(f"{route}:{reason}", 0) + 1
+
+    def record(self, route: str, model: str, seconds: float, response):
+        usage = getattr(response, "usage_metadata", None) or {}
+        stats = self.routes.setdefault(route, {"model": model, "calls": 0, "seconds": 0.0,
+                                               "input_tokens": 0, "output_tokens": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["input_tokens"] += usage.get("input_tokens", 0)
+        stats["output_tokens"] += usage.get("output_tokens", 0)
+
+    def report(self):
+        out = {}
+        for route, stats in self.routes.items():
+            price_in, price_out = PRICES.get(stats["model"], (0.0, 0.0))
+            out[route] = dict(
+                stats,
+                avg_ms=stats["seconds"] / stats["calls"] * 1e3,
+                cost_usd=(stats["input_tokens"] * price_in + stats["output_tokens"] * price_out) / 1e6,
+            )
+        return {"routes": out, "decisions": dict(self.reasons)}
+
+
+route_stats = route_recorder()
@@ -0,0 +1,197 @@
+# %%
+"""One scheduler in front of every gemini call.
+
+Calls wait in a priority queue (user facing chat before summaries) for a concurrency
+slot and for room in two token buckets, requests per minute and tokens per minute,
+sized to the project's gemini quota. A 429 goes back through the queue after a
+jittered exponential backoff. When the queue is deeper than SCHEDULER_MAX_QUEUE, or a
+call would wait longer than SCHEDULER_MAX_WAIT, it is shed at once with `overloaded`
+so the api can answer with an error event instead of letting every stream time out.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from tokens import message_tokens
+
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "1000"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+# output tokens reserved per call until the real usage is known
+GEMINI_OUTPUT_TOKENS = int(os.getenv("GEMINI_OUTPUT_TOKENS", "1024"))
+SCHEDULER_MAX_CONCURRENT = int(os.getenv("SCHEDULER_MAX_CONCURRENT", "32"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "64"))
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "20"))
+SCHEDULER_RETRIES = int(os.getenv("SCHEDULER_RETRIES", "3"))
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# lower runs first
+PRIORITIES = {"chat": 0, "summary": 1}
+
+
+class overloaded(Exception):
+    """the call was shed, the model is saturated"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def rate_limited(error: Exception) -> bool:
+    """429 / RESOURCE_EXHAUSTED from the gemini client, however it was wrapped"""
+    while error is not None:
+        if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+            return True
+        if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+            return True
+        if "RESOURCE_EXHAUSTED" in str(error) or "429" in str(error)[:200]:
+            return True
+        error = error.__cause__
+    return False
+
+
+def backoff(attempt: int) -> float:
+    """full jitter: spreads the retries of calls that were rejected together"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+# %%
+class token_bucket:
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        # a call bigger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.refill()
+        self.level -= amount
+
+    def give_back(self, amount: float):
+        # may go below zero: a call that used more than reserved is paid by the next ones
+        self.level = min(self.capacity, self.level + amount)
+
+
+# %%
+class model_scheduler:
+    def __init__(self, rpm: float = GEMINI_RPM, tpm: float = GEMINI_TPM,
+                 max_concurrent: int = SCHEDULER_MAX_CONCURRENT, max_queue: int = SCHEDULER_MAX_QUEUE,
+                 max_wait: float = SCHEDULER_MAX_WAIT):
+        self.requests = token_bucket(rpm)
+        self.tokens = token_bucket(tpm)
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.waiting = []
+        self.running = 0
+        self.order = itertools.count()
+        self._condition = None
+        self.stats = {"calls": 0, "shed": 0, "rate_limited": 0, "retries": 0, "wait_seconds": 0.0,
+                      "by_priority": {name: 0 for name in PRIORITIES}}
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # created on first use so it belongs to the loop the api runs on
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def saturated(self) -> bool:
+        return len(self.waiting) >= self.max_queue
+
+    async def acquire(self, priority: int, tokens: int):
+        # summaries are shed first, at half the depth a user facing call is
+        if len(self.waiting) >= (self.max_queue if priority == PRIORITIES["chat"] else self.max_queue // 2):
+            self.stats["shed"] += 1
+            raise overloaded(f"{len(self.waiting)} model calls are already queued", retry_after=self.max_wait)
+        entry = [priority, next(self.order), tokens]
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        async with self.condition:
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    wait = None
+                    if self.waiting[0] is entry and self.running < self.max_concurrent:
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                        if wait == 0:
+                            break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        self.stats["shed"] += 1
+                        raise overloaded("the model quota is exhausted for now",
+                                         retry_after=wait if wait is not None else self.max_wait)
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), min(remaining, wait or remaining))
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+                raise
+            heapq.heappop(self.waiting)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.running += 1
+            self.stats["wait_seconds"] += time.monotonic() - started
+            # the next in line may be able to go too
+            self.condition.notify_all()
+
+    async def release(self):
+        async with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    async def call(self, model, messages, priority: str = "chat"):
+        """`model.ainvoke(messages)` once the quota allows it, 429s are retried"""
+        reserved = sum(message_tokens(m) for m in messages) + GEMINI_OUTPUT_TOKENS
+        for attempt in range(SCHEDULER_RETRIES + 1):
+            await self.acquire(PRIORITIES[priority], reserved)
+            try:
+                response = await model.ainvoke(messages)
+            except Exception as e:
+                if not rate_limited(e):
+                    raise
+                self.stats["rate_limited"] += 1
+                if attempt == SCHEDULER_RETRIES:
+                    raise overloaded("the model is rate limited", retry_after=BACKOFF_MAX) from e
+                self.stats["retries"] += 1
+                delay = backoff(attempt)
+            else:
+                self.stats["calls"] += 1
+                self.stats["by_priority"][priority] += 1
+                used = (getattr(response, "usage_metadata", None) or {}).get("total_tokens")
+                if used:
+                    self.tokens.give_back(reserved - used)
+                return response
+            finally:
+                await self.release()
+            await asyncio.sleep(delay)
+
+    def report(self):
+        calls = self.stats["calls"]
+        return dict(
+            self.stats,
+            queued=len(self.waiting),
+            running=self.running,
+            request_budget=round(self.requests.level, 1),
+            token_budget=round(self.tokens.level),
+            avg_wait_ms=self.stats["wait_seconds"] / calls * 1e3 if calls else 0.0,
+        )
+
+
+scheduler = model_scheduler()
@@ -0,0 +1,326 @@
+# %%
+"""Appointment slots of doctors, one bitmap per doctor and day.
+
+A day is cut into SLOT_MINUTES slots, a `slot_days` document holds two of them as
+64 bit integers: `open` (the doctor's hours, from the slots text of the doctor graph,
+SLOT_HOURS for doctors without one) and `taken`. Booking is one conditional update,
+matched only while every bit of the slot is still clear:
+
+    {_id, taken: {$bitsAllClear: mask}}  ->  {$bit: {taken: {or: mask}}}
+
+upserted, so the first booking of a day creates its document and a lost race ends in
+a duplicate key instead of a double booking. Two first bookings of a day also collide
+on the insert when their slots differ, so a duplicate key is retried once, against the
+document that exists by then, before it counts as a conflict. Cancelling clears the
+bits the same way.
+Availability is answered from an in-memory mirror of the bitmaps, refreshed from
+mongo after MIRROR_SECONDS or whenever a booking finds the mirror was stale. Each
+booked slot is also an `appointments` document, indexed on user, doctor and date, and
+the user's upcoming appointments are copied into their `bookings` document, whose change
+stream the backend broadcasts. `python check_slots.py` runs all of it against a real mongo.
+"""
+import os
+import re
+import threading
+import time
+from datetime import date as date_, datetime, timezone
+from bson.int64 import Int64
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from resources import mongo
+from doctor_lookup import doctor_slots
+
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", "30"))
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+# hours of a doctor without a schedule of their own, the placeholder's 9-12 and 4-7
+SLOT_HOURS = os.getenv("SLOT_HOURS", "09:00-12:00,16:00-19:00")
+MIRROR_SECONDS = float(os.getenv("SLOT_MIRROR_SECONDS", "15"))
+if SLOTS_PER_DAY > 63:
+    raise ValueError("a day bitmap is one signed 64 bit integer, SLOT_MINUTES must be 23 or more")
+
+
+class slot_error(ValueError):
+    """a date, time or doctor the model passed that cannot be booked"""
+
+
+def key(text: str) -> str:
+    return " ".join(str(text).split()).lower()
+
+
+def day_id(doctor: str, hospital: str, day: str) -> str:
+    return f"{key(hospital)}|{key(doctor)}|{day}"
+
+
+def parse_day(text: str) -> str:
+    try:
+        day = date_.fromisoformat(str(text).strip())
+    except ValueError:
+        raise slot_error(f"{text!r} is not a date, use YYYY-MM-DD")
+    if day < date_.today():
+        raise slot_error(f"{day} is in the past")
+    return day.isoformat()
+
+
+def parse_slot(text: str) -> int:
+    """'16:30', '4:30 pm', '9 am' -> index of the slot starting then"""
+    match = re.fullmatch(r"\s*(\d{1,2})(?:[:.](\d{2}))?\s*([ap]\.?m\.?)?\s*", str(text).lower())
+    if match is None:
+        raise slot_error(f"{text!r} is not a time, use HH:MM")
+    hour, minute, half = int(match.group(1)), int(match.group(2) or 0), match.group(3)
+    if half:
+        hour = hour % 12 + (12 if half.startswith("p") else 0)
+    if hour > 23 or minute > 59 or minute % SLOT_MINUTES:
+        raise slot_error(f"{text!r} is not the start of a {SLOT_MINUTES} minute slot")
+    return (hour * 60 + minute) // SLOT_MINUTES
+
+
+def first_slot(day: str) -> int:
+    """the first slot of a day that can still be booked, later than now for today"""
+    if day != date_.today().isoformat():
+        return 0
+    now = datetime.now()
+    return (now.hour * 60 + now.minute) // SLOT_MINUTES + 1
+
+
+def slot_time(slot: int) -> str:
+    return f"{slot * SLOT_MINUTES // 60:02d}:{slot * SLOT_MINUTES % 60:02d}"
+
+
+def hours_mask(hours: str) -> int:
+    mask = 0
+    for span in hours.split(","):
+        start, end = span.split("-")
+        for slot in range(parse_slot(start), parse_slot(end)):
+            mask |= 1 << slot
+    return mask
+
+
+DEFAULT_OPEN = hours_mask(SLOT_HOURS)
+
+CLOCK = r"(\d{1,2})(?:[:.](\d{2}))?\s*([ap])?\.?m?\.?"
+SPAN = re.compile(rf"\b{CLOCK}\s*(?:-|–|to|till|until)\s*{CLOCK}")
+
+
+def minutes(hour: str, minute: str | None, half: str | None) -> int:
+    hour = int(hour)
+    if half:
+        hour = hour % 12 + (12 if half == "p" else 0)
+    return hour * 60 + int(minute or 0)
+
+
+def schedule_mask(text: str) -> int:
+    """open slots of a free text schedule, every "<time> to <time>" in it:
+    'Morning 9 am to 12 am and evening 4 pm to 7 pm', 'Mon 10-1', '16:00-19:00'.
+    Weekdays are not told apart, 0 when no span is found"""
+    mask = 0
+    for match in SPAN.finditer(str(text).lower()):
+        start_hour, start_minute, start_half, end_hour, end_minute, end_half = match.groups()
+        if int(start_hour) > 23 or int(end_hour) > 23 or int(start_minute or 0) > 59 or int(end_minute or 0) > 59:
+            continue
+        end = minutes(end_hour, end_minute, end_half)
+        start = minutes(start_hour, start_minute, start_half)
+        if start_half is None and end_half is not None and minutes(start_hour, start_minute, end_half) < end:
+            # '4 to 7 pm'
+            start = minutes(start_hour, start_minute, end_half)
+        if end <= start and end + 12 * 60 <= 24 * 60:
+            # '10-1', and '9 am to 12 am' meaning noon
+            end += 12 * 60
+        for slot in range(-(-start // SLOT_MINUTES), end // SLOT_MINUTES):
+            mask |= 1 << slot
+    return mask
+
+
+def open_hours(doctor: str, hospital: str) -> int:
+    schedule = doctor_slots(doctor, hospital)
+    return (schedule_mask(schedule) if schedule else 0) or DEFAULT_OPEN
+
+
+# %%
+class slot_inventory:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # day id -> [open, taken, loaded at]
+        self.mirror: dict[str, list] = {}
+        self.ready = False
+        self.stats = {"checks": 0, "mirror_hits": 0, "loads": 0, "booked": 0, "retries": 0, "conflicts": 0,
+                      "cancelled": 0}
+
+    def collections(self):
+        db = mongo()[os.environ["DBNAME"]]
+        days, appointments = db["slot_days"], db["appointments"]
+        if not self.ready:
+            appointments.create_index([("user_id", ASCENDING), ("date", ASCENDING)])
+            appointments.create_index([("doctor_key", ASCENDING), ("date", ASCENDING)])
+            # a second guard against double booking, next to the bitmap
+            appointments.create_index([("day_id", ASCENDING), ("slot", ASCENDING)], unique=True)
+            self.ready = True
+        return days, appointments
+
+    def load(self, ids: dict[str, tuple[str, str]]):
+        days, _ = self.collections()
+        found = {d["_id"]: d for d in days.find({"_id": {"$in": list(ids)}}, {"open": 1, "taken": 1})}
+        # a day without a document yet opens with the doctor's schedule
+        open_ = {id_: open_hours(*ids[id_]) for id_ in ids if id_ not in found}
+        now = time.monotonic()
+        with self.lock:
+            for id_ in ids:
+                doc = found.get(id_, {})
+                self.mirror[id_] = [int(doc.get("open", open_.get(id_, DEFAULT_OPEN))), int(doc.get("taken", 0)), now]
+            self.stats["loads"] += 1
+
+    def bitmaps(self, ids: dict[str, tuple[str, str]]) -> dict[str, tuple[int, int]]:
+        """day id -> (open, taken), for day ids mapped to their (doctor, hospital)"""
+        now = time.monotonic()
+        stale = {i: ids[i] for i in ids if i not in self.mirror or now - self.mirror[i][2] > MIRROR_SECONDS}
+        if stale:
+            self.load(stale)
+        else:
+            self.stats["mirror_hits"] += 1
+        return {i: tuple(self.mirror[i][:2]) for i in ids}
+
+    def free(self, doctor: str, hospital: str, day: str) -> list[str]:
+        """start times of the free slots, from the mirror"""
+        self.stats["checks"] += 1
+        day = parse_day(day)
+        id_ = day_id(doctor, hospital, day)
+        open_, taken = self.bitmaps({id_: (doctor, hospital)})[id_]
+        free = open_ & ~taken
+        return [slot_time(s) for s in range(first_slot(day), SLOTS_PER_DAY) if free >> s & 1]
+
+    def mark(self, id_: str, mask: int, taken: bool):
+        with self.lock:
+            if id_ in self.mirror:
+                self.mirror[id_][1] = self.mirror[id_][1] | mask if taken else self.mirror[id_][1] & ~mask
+
+    def book(self, user_id: str, requests: list[dict]) -> list[dict]:
+        """books every {doctor, hospital, date, time} it can, in one bulk write of
+        conditional updates. Returns one result per request, in order"""
+        results, wanted = [None] * len(requests), {}
+        for n, request in enumerate(requests):
+            try:
+                day = parse_day(request["date"])
+                slot = parse_slot(request["time"])
+            except slot_error as e:
+                results[n] = {"booked": False, "reason": str(e)}
+                continue
+            if slot < first_slot(day):
+                results[n] = {"booked": False, "reason": f"{slot_time(slot)} today has already passed"}
+                continue
+            id_ = day_id(request["doctor"], request["hospital"], day)
+            wanted.setdefault(id_, {})
+            if slot in wanted[id_]:
+                results[n] = {"booked": False, "reason": "asked twice in this booking"}
+                continue
+            wanted[id_][slot] = (n, dict(doctor=request["doctor"], hospital=request["hospital"], date=day))
+        if not wanted:
+            return results
+        # every request of a day has the same doctor and hospital
+        bitmaps = self.bitmaps({id_: next((r["doctor"], r["hospital"]) for _, r in slots.values())
+                                for id_, slots in wanted.items()})
+        ops, op_ids = [], []
+        for id_, slots in wanted.items():
+            open_, taken = bitmaps[id_]
+            mask = 0
+            for slot, (n, request) in slots.items():
+                if not open_ >> slot & 1:
+                    results[n] = {"booked": False, "reason": "the doctor does not see patients then"}
+                elif taken >> slot & 1:
+                    results[n] = {"booked": False, "reason": "already booked"}
+                else:
+                    mask |= 1 << slot
+            if not mask:
+                continue
+            request = next(iter(slots.values()))[1]
+            ops.append(UpdateOne({"_id": id_, "taken": {"$bitsAllClear": Int64(mask)}},
+                                 {"$bit": {"taken": {"or": Int64(mask)}},
+                                  "$setOnInsert": {"doctor_key": key(request["doctor"]), "hospital_key": key(request["hospital"]),
+                                                   "date": request["date"], "open": Int64(open_)}},
+                                 upsert=True))
+            op_ids.append((id_, mask))
+        if ops:
+            days, appointments = self.collections()
+            failed = self.write(days, ops)
+            if failed:
+                # two first bookings of a day both insert, the loser's slots may still be free
+                retry = sorted(failed)
+                self.stats["retries"] += len(retry)
+                failed = {retry[index] for index in self.write(days, [ops[i] for i in retry])}
+            booked = []
+            for index, (id_, mask) in enumerate(op_ids):
+                if index in failed:
+                    self.stats["conflicts"] += 1
+                    with self.lock:
+                        self.mirror.pop(id_, None)
+                    for slot, (n, _) in wanted[id_].items():
+                        if mask >> slot & 1:
+                            results[n] = {"booked": False, "reason": "booked by someone else meanwhile, check the availability again"}
+                    continue
+                self.mark(id_, mask, taken=True)
+                for slot, (n, request) in wanted[id_].items():
+                    if mask >> slot & 1:
+                        booked.append((n, dict(request, user_id=user_id, doctor_key=key(request["doctor"]),
+                                               time=slot_time(slot), day_id=id_, slot=slot,
+                                               created=datetime.now(timezone.utc))))
+                        results[n] = {"booked": True, **{k: request[k] for k in ("doctor", "hospital", "date")},
+                                      "time": slot_time(slot)}
+            if booked:
+                try:
+                    appointments.insert_many([doc for _, doc in booked], ordered=False)
+                except BulkWriteError as e:
+                    for error in e.details["writeErrors"]:
+                        if error["code"] != 11000:
+                            raise
+                        # the slot has an appointment the bitmap had lost, it stays taken
+                        results[booked[error["index"]][0]] = {"booked": False, "reason": "already booked"}
+                self.stats["booked"] += sum(1 for n, _ in booked if results[n]["booked"])
+                self.publish(user_id)
+        return results
+
+    @staticmethod
+    def write(days, ops: list) -> set[int]:
+        """indexes of the ops that lost their slots"""
+        try:
+            days.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            failed = set()
+            for error in e.details["writeErrors"]:
+                if error["code"] != 11000:
+                    raise
+                # not matched: some bit was taken meanwhile, the upsert then collides on _id
+                failed.add(error["index"])
+            return failed
+        return set()
+
+    def publish(self, user_id: str):
+        """the user's upcoming appointments into `bookings`, the backend watches its changes"""
+        upcoming = self.appointments(user_id)
+        mongo()[os.environ["DBNAME"]]["bookings"].replace_one(
+            {"_id": user_id},
+            {"_id": user_id, "hospitals": list(dict.fromkeys(a["hospital"] for a in upcoming)),
+             "doctors": list(dict.fromkeys(a["doctor"] for a in upcoming)), "appointments": upcoming},
+            upsert=True)
+
+    def cancel(self, user_id: str, doctor: str, hospital: str, day: str, at: str) -> bool:
+        day, slot = parse_day(day), parse_slot(at)
+        id_ = day_id(doctor, hospital, day)
+        days, appointments = self.collections()
+        if appointments.delete_one({"user_id": user_id, "day_id": id_, "slot": slot}).deleted_count == 0:
+            return False
+        mask = Int64(1 << slot)
+        days.update_one({"_id": id_, "taken": {"$bitsAllSet": mask}}, {"$bit": {"taken": {"and": Int64(~(1 << slot))}}})
+        self.mark(id_, 1 << slot, taken=False)
+        self.stats["cancelled"] += 1
+        self.publish(user_id)
+        return True
+
+    def appointments(self, user_id: str) -> list[dict]:
+        _, appointments = self.collections()
+        return list(appointments.find({"user_id": user_id, "date": {"$gte": date_.today().isoformat()}},
+                                      {"_id": 0, "doctor": 1, "hospital": 1, "date": 1, "time": 1})
+                    .sort([("date", ASCENDING), ("slot", ASCENDING)]))
+
+    def report(self):
+        return dict(self.stats, mirrored_days=len(self.mirror))
+
+
+inventory = slot_inventory()
@@ -0,0 +1,52 @@
+# %%
+import json
+import os
+from langchain_core.messages import BaseMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+# approx: chars/3 heuristic, no dependency. tiktoken: real BPE counts (cl100k_base),
+# slower but closer when the budget has to be tight
+TOKENIZER = os.getenv("TOKENIZER", "approx")
+EXTRA_TOKENS_PER_MESSAGE = 60
+
+_encoding = None
+
+
+def approx_tokens(message: BaseMessage) -> int:
+    return count_tokens_approximately(messages=[message],chars_per_token=3,extra_tokens_per_message=EXTRA_TOKENS_PER_MESSAGE)
+
+
+def tiktoken_tokens(message: BaseMessage) -> int:
+    global _encoding
+    if _encoding is None:
+        import tiktoken
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    text = message.content if isinstance(message.content, str) else json.dumps(message.content, default=str)
+    if getattr(message, "tool_calls", None):
+        text += json.dumps(message.tool_calls, default=str)
+    return len(_encoding.encode(text, disallowed_special=())) + EXTRA_TOKENS_PER_MESSAGE
+
+
+tokenizers = {
+    "approx": approx_tokens,
+    "tiktoken": tiktoken_tokens,
+}
+
+
+def message_tokens(message: BaseMessage) -> int:
+    """token estimate of a message, computed once and kept in its response_metadata
+    so it is stored with the message in the checkpoint"""
+    tokens = message.response_metadata.get("tokens")
+    if tokens is None:
+        tokens = tokenizers[TOKENIZER](message)
+        message.response_metadata["tokens"] = tokens
+    return tokens
+
+
+def uncounted(messages: list[BaseMessage]) -> list[BaseMessage]:
+    """the messages at the end of the list that have no token count yet (new input),
+    or every message of a thread that was written before counting existed"""
+    start = len(messages)
+    while start > 0 and "tokens" not in messages[start - 1].response_metadata:
+        start -= 1
+    return messages[start:]
@@ -0,0 +1,90 @@
+# %%
+"""Tools whose implementation is imported on first use.
+
+The model needs every tool schema when it is bound, the implementations only when a
+tool is called. A lazy tool is declared as a stub (signature + docstring, which become
+the schema exactly like with @tool) pointing at `module:function`; the module, and the
+heavy dependencies it imports, are loaded the first time the tool runs.
+"""
+import asyncio
+import functools
+import importlib
+import inspect
+import logging
+import threading
+import time
+from langchain.tools import tool
+
+logger = logging.getLogger("tool_registry")
+
+# tool name -> seconds its implementation took to import
+load_times: dict[str, float] = {}
+_lazy = {}
+_lock = threading.Lock()
+
+
+def lazy_tool(target: str):
+    module_name, attr = target.split(":")
+
+    def decorator(stub):
+        implementation = None
+
+        def resolve():
+            nonlocal implementation
+            if implementation is None:
+                with _lock:
+                    if implementation is None:
+                        started = time.perf_counter()
+                        implementation = getattr(importlib.import_module(module_name), attr)
+                        load_times[stub.__name__] = time.perf_counter() - started
+            return implementation
+
+        if inspect.iscoroutinefunction(stub):
+            @functools.wraps(stub)
+            async def run(*args, **kwargs):
+                # the import runs off the event loop, it can take a while the first time
+                function = implementation or await asyncio.to_thread(resolve)
+                if inspect.iscoroutinefunction(function):
+                    return await function(*args, **kwargs)
+                return await asyncio.to_thread(function, *args, **kwargs)
+        else:
+            @functools.wraps(stub)
+            def run(*args, **kwargs):
+                return resolve()(*args, **kwargs)
+
+        _lazy[stub.__name__] = resolve
+        return tool(run)
+    return decorator
+
+
+def preload(names=None):
+    """import the implementations now, e.g. in the background once the api is up"""
+    for name in names or list(_lazy):
+        try:
+            _lazy[name]()
+        except Exception:
+            # the tool call itself will report the error again
+            logger.exception("could not load the implementation of %s", name)
+    return dict(load_times)
+
+
+def stats():
+    return {name: {"loaded": name in load_times, "import_ms": load_times.get(name, 0.0) * 1e3} for name in _lazy}
+
+
+# %%
+@lazy_tool("calculator:evaluate")
+def evaluate_expression(expr: str) -> str:
+    '''Evaluates any maths expression'''
+
+
+@lazy_tool("web_search:search_duckduckgo")
+async def search_duckduckgo(query: str):
+    """search the web using DuckDuckGo"""
+
+
+@lazy_tool("gemini_embedding:disease_data_search_from_database")
+async def search_disease_info(query: str):
+    """a tool to search about a particular type of health issue or disease. It performs vector search
+    to get related info. The query given to this tool must be properly made so that you get relevant and
+    important information"""
@@ -0,0 +1,155 @@
+# %%
+"""One turn at a time per thread.
+
+A turn runs as a task of its own and publishes its SSE events into a buffer, the
+request that started it (and any client that reattaches later) only follows that
+buffer. So a closed connection does not cancel the turn half way, a retried request
+with the same idempotency key follows the running (or just finished) turn instead of
+starting a second one, and a new message for a busy thread waits for the running turn
+(TURN_POLICY=queue) or is refused (TURN_POLICY=reject). A request without a key is only
+folded into an identical message of the thread that is still running, the same text
+sent again later ("yes", "ok") is a new turn.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("turns")
+
+TURN_POLICY = os.getenv("TURN_POLICY", "queue")
+# turns that may wait behind the running one of a thread before new ones are refused
+TURN_MAX_QUEUED = int(os.getenv("TURN_MAX_QUEUED", "2"))
+# a finished turn is replayed to a retry with the same explicit idempotency key for this long
+TURN_REPLAY_SECONDS = float(os.getenv("TURN_REPLAY_SECONDS", "120"))
+# a finished turn without a key is only kept for clients reattaching to it
+TURN_KEEP_SECONDS = float(os.getenv("TURN_KEEP_SECONDS", "10"))
+
+
+def error_event(error: str, message: str, **extra) -> str:
+    return f"event: error\ndata: {json.dumps(dict(error=error, message=message, **extra))}\n\n"
+
+
+# %%
+class turn:
+    def __init__(self, thread_id: str, key: str, keep_for: float):
+        self.thread_id = thread_id
+        self.key = key
+        self.keep_for = keep_for
+        self.events: list[str] = []
+        self.done = False
+        self.finished_at = None
+        self.task = None
+        self.changed = asyncio.Condition()
+
+    async def publish(self, event: str):
+        async with self.changed:
+            self.events.append(event)
+            self.changed.notify_all()
+
+    async def finish(self):
+        async with self.changed:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self.changed.notify_all()
+
+    def expired(self, now: float) -> bool:
+        return self.done and now - self.finished_at > self.keep_for
+
+    async def follow(self, offset: int = 0):
+        """every event of the turn from `offset` on, live until the turn is done"""
+        while True:
+            while offset < len(self.events):
+                yield self.events[offset]
+                offset += 1
+            if self.done:
+                return
+            async with self.changed:
+                if offset >= len(self.events) and not self.done:
+                    await self.changed.wait()
+
+
+# %%
+class turn_manager:
+    def __init__(self, policy: str = TURN_POLICY, max_queued: int = TURN_MAX_QUEUED):
+        self.policy = policy
+        self.max_queued = max_queued
+        # thread_id -> lock held by the running turn, and how many turns hold or wait for it
+        self.threads: dict[str, dict] = {}
+        self.turns: OrderedDict[tuple[str, str], turn] = OrderedDict()
+        self.stats = {"started": 0, "queued": 0, "rejected": 0, "deduplicated": 0, "reattached": 0, "failed": 0}
+
+    def expire(self):
+        now = time.monotonic()
+        for key in [k for k, t in self.turns.items() if t.expired(now)]:
+            del self.turns[key]
+
+    def submit(self, thread_id: str, message: str, key: str | None, producer):
+        """the turn that answers this message: a running or recent one with the same key
+        (without a key, a running one with the same text), a new one, or None if the thread
+        is busy and the turn was refused"""
+        self.expire()
+        explicit = bool(key)
+        keep_for = TURN_REPLAY_SECONDS if explicit else TURN_KEEP_SECONDS
+        key = key or "message:" + hashlib.sha1(message.encode("utf-8")).hexdigest()
+        existing = self.turns.get((thread_id, key))
+        if existing is not None and (explicit or not existing.done):
+            self.stats["deduplicated"] += 1
+            return existing
+        state = self.threads.setdefault(thread_id, {"lock": asyncio.Lock(), "pending": 0})
+        if state["pending"] and (self.policy == "reject" or state["pending"] > self.max_queued):
+            self.stats["rejected"] += 1
+            return None
+        if state["pending"]:
+            self.stats["queued"] += 1
+        state["pending"] += 1
+        new = turn(thread_id, key, keep_for)
+        # a finished turn with the same text goes, the new one is appended in submission order
+        self.turns.pop((thread_id, key), None)
+        self.turns[(thread_id, key)] = new
+        new.task = asyncio.create_task(self.run(new, state, producer))
+        self.stats["started"] += 1
+        return new
+
+    async def run(self, new: turn, state: dict, producer):
+        try:
+            async with state["lock"]:
+                async for event in producer():
+                    await new.publish(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.exception("turn of thread %s failed", new.thread_id)
+            await new.publish(error_event("failed", str(e)))
+        finally:
+            state["pending"] -= 1
+            if not state["pending"] and self.threads.get(new.thread_id) is state:
+                del self.threads[new.thread_id]
+            await new.finish()
+
+    def latest(self, thread_id: str):
+        """the running turn of a thread, or its most recent one if none runs"""
+        self.expire()
+        candidates = [t for (thread, _), t in self.turns.items() if thread == thread_id]
+        if not candidates:
+            return None
+        self.stats["reattached"] += 1
+        # turns are kept in submission order, the first one not done is the running one
+        return next((t for t in candidates if not t.done), candidates[-1])
+
+    async def shutdown(self):
+        tasks = [t.task for t in self.turns.values() if not t.done]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def report(self):
+        return dict(self.stats, running=sum(1 for t in self.turns.values() if not t.done),
+                    busy_threads=len(self.threads), buffered_turns=len(self.turns))
+
+
+turns = turn_manager()
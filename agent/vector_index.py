@@ -0,0 +1,152 @@
+# %%
+import json
+import os
+import sys
+import numpy as np
+from langchain_core.documents import Document
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "vector_index")
+IVF_NLIST = int(os.getenv("IVF_NLIST", "64"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """indices of the k highest scores, best first"""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+# %%
+def export_corpus(collection, out_dir: str = VECTOR_INDEX_DIR, text_key: str = "text",
+                  embedding_key: str = "embedding"):
+    """Dump the corpus of a mongo collection (the `vectorsearches` one, or any local copy)
+    into `embeddings.npy` (row normalized float32, row major) and `documents.jsonl`."""
+    os.makedirs(out_dir, exist_ok=True)
+    cursor = collection.find({embedding_key: {"$exists": True}})
+    rows = []
+    with open(os.path.join(out_dir, "documents.jsonl"), "w", encoding="utf-8") as docs:
+        for doc in cursor:
+            rows.append(np.asarray(doc.pop(embedding_key), dtype=np.float32))
+            text = doc.pop(text_key, "")
+            doc["_id"] = str(doc["_id"])
+            docs.write(json.dumps({"page_content": text, "metadata": doc}, default=str) + "\n")
+    if not rows:
+        raise ValueError(f"no documents with a `{embedding_key}` field in {collection.name}")
+    matrix = normalize_rows(np.vstack(rows)).astype(np.float32)
+    mm = np.lib.format.open_memmap(os.path.join(out_dir, "embeddings.npy"), mode="w+",
+                                   dtype=np.float32, shape=matrix.shape)
+    mm[:] = matrix
+    mm.flush()
+    return matrix.shape
+
+
+# %%
+class local_vector_index:
+    """Corpus embeddings as one contiguous float32 matrix memory mapped from disk.
+
+    `exact` scores every row (cosine, the rows are normalized) and is the reference.
+    `ivf` clusters the rows with k-means into `nlist` lists and only scores the rows
+    of the `nprobe` lists whose centroids are closest to the query.
+    """
+
+    def __init__(self, matrix: np.ndarray, documents: list[Document], mode: str = "exact",
+                 nlist: int = IVF_NLIST, nprobe: int = IVF_NPROBE, index_dir: str | None = None):
+        self.matrix = matrix
+        self.documents = documents
+        self.mode = mode
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.index_dir = index_dir
+        self.centroids = None
+        self.list_offsets = None
+        self.list_rows = None
+        if mode == "ivf":
+            self.load_or_build_ivf()
+
+    @classmethod
+    def load(cls, index_dir: str = VECTOR_INDEX_DIR, mode: str = "exact", **kwargs):
+        matrix = np.load(os.path.join(index_dir, "embeddings.npy"), mmap_mode="r")
+        with open(os.path.join(index_dir, "documents.jsonl"), encoding="utf-8") as f:
+            documents = [Document(**json.loads(line)) for line in f]
+        return cls(matrix, documents, mode=mode, index_dir=index_dir, **kwargs)
+
+    # %%
+    def build_ivf(self, iterations: int = 20, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        n = self.matrix.shape[0]
+        nlist = max(1, min(self.nlist, n))
+        centroids = np.array(self.matrix[rng.choice(n, nlist, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            assign = self.assign(centroids)
+            for c in range(nlist):
+                members = self.matrix[assign == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize_rows(centroids).astype(np.float32)
+        assign = self.assign(centroids)
+        # rows grouped by list so probing a list reads one contiguous slice of list_rows
+        self.list_rows = np.argsort(assign, kind="stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        self.centroids = centroids
+
+    def assign(self, centroids, batch: int = 8192):
+        out = np.empty(self.matrix.shape[0], dtype=np.int64)
+        for start in range(0, self.matrix.shape[0], batch):
+            out[start:start + batch] = np.argmax(self.matrix[start:start + batch] @ centroids.T, axis=1)
+        return out
+
+    def load_or_build_ivf(self):
+        path = os.path.join(self.index_dir, f"ivf_{self.nlist}.npz") if self.index_dir else None
+        if path and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(
+                os.path.join(self.index_dir, "embeddings.npy")):
+            saved = np.load(path)
+            self.centroids, self.list_rows, self.list_offsets = saved["centroids"], saved["list_rows"], saved["list_offsets"]
+            return
+        self.build_ivf()
+        if path:
+            np.savez(path, centroids=self.centroids, list_rows=self.list_rows, list_offsets=self.list_offsets)
+
+    # %%
+    def search_exact(self, query: np.ndarray, k: int):
+        scores = self.matrix @ query
+        idx = top_k(scores, k)
+        return idx, scores[idx]
+
+    def search_ivf(self, query: np.ndarray, k: int, nprobe: int | None = None):
+        probes = top_k(self.centroids @ query, nprobe or self.nprobe)
+        candidates = np.concatenate([self.list_rows[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probes])
+        candidates.sort()  # sequential reads from the memory map
+        scores = self.matrix[candidates] @ query
+        best = top_k(scores, k)
+        return candidates[best], scores[best]
+
+    def search(self, embedding, k: int = 5, mode: str | None = None):
+        query = normalize_rows(np.asarray(embedding, dtype=np.float32))
+        if (mode or self.mode) == "ivf":
+            return self.search_ivf(query, k)
+        return self.search_exact(query, k)
+
+    def similarity_search_by_vector(self, embedding, k: int = 5, **kwargs):
+        idx, scores = self.search(embedding, k)
+        return [Document(page_content=self.documents[i].page_content,
+                         metadata=dict(self.documents[i].metadata, score=float(s)))
+                for i, s in zip(idx, scores)]
+
+
+# %%
+if __name__ == "__main__":
+    # python vector_index.py export   -> dumps the vectorsearches collection to VECTOR_INDEX_DIR
+    if sys.argv[1:] == ["export"]:
+        from pymongo import MongoClient
+        from dotenv import load_dotenv
+        load_dotenv()
+        client = MongoClient(os.environ["MONGOURI"])
+        print(export_corpus(client[os.getenv("VECTOR_DB_NAME", "test")]["vectorsearches"]))
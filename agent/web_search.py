@@ -0,0 +1,104 @@
+# %%
+import asyncio
+import json
+import os
+import threading
+import time
+from ddgs import DDGS
+from embedding_cache import disk_lru_cache, normalize_query
+
+SEARCH_MAX_RESULTS = 5
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "300"))
+
+# normalized query -> compact result records. Health questions do not go stale within
+# hours, and a flu season burst of the same question is answered from here
+search_results = disk_lru_cache("search_results", ttl=float(os.getenv("SEARCH_CACHE_TTL", str(6 * 3600))),
+                                max_items=20000, max_memory=1024)
+# normalized query -> the search running for it, later identical queries wait on it
+in_flight: dict[str, asyncio.Task] = {}
+stats = {"searches": 0, "coalesced": 0, "upstream": 0, "upstream_seconds": 0.0, "errors": 0,
+         "raw_chars": 0, "compact_chars": 0}
+
+_local = threading.local()
+
+
+def ddgs() -> DDGS:
+    # one instance per to_thread worker: DDGS keeps per instance http sessions and is not
+    # thread safe, each worker still reuses its search engine clients between calls
+    if getattr(_local, "ddgs", None) is None:
+        _local.ddgs = DDGS()
+    return _local.ddgs
+
+
+def snippet(text: str, limit: int = SEARCH_SNIPPET_CHARS) -> str:
+    text = " ".join((text or "").split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "..."
+
+
+def compact(results: list[dict]) -> list[dict]:
+    """title, snippet and url of each result, without duplicates of the same page"""
+    records, seen = [], set()
+    for result in results:
+        url = result.get("href") or result.get("url") or ""
+        if url in seen:
+            continue
+        seen.add(url)
+        records.append({"title": result.get("title", ""), "snippet": snippet(result.get("body", "")), "url": url})
+    return records
+
+
+async def fetch(key: str) -> list[dict]:
+    started = time.perf_counter()
+    try:
+        results = await asyncio.to_thread(lambda: ddgs().text(key, max_results=SEARCH_MAX_RESULTS))
+    except Exception:
+        stats["errors"] += 1
+        raise
+    finally:
+        stats["upstream"] += 1
+        stats["upstream_seconds"] += time.perf_counter() - started
+    records = compact(results or [])
+    stats["raw_chars"] += len(str(results))
+    stats["compact_chars"] += len(json.dumps(records, ensure_ascii=False))
+    if records:
+        # sqlite, off the event loop like the search itself
+        await asyncio.to_thread(search_results.put, key, records)
+    return records
+
+
+def finished(key: str, task: asyncio.Task):
+    in_flight.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # retrieved here too, in case every waiter was cancelled
+
+
+async def search_duckduckgo(query: str):
+    stats["searches"] += 1
+    key = normalize_query(query)
+    records = await asyncio.to_thread(search_results.get, key)
+    if records is None:
+        task = in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch(key))
+            in_flight[key] = task
+            task.add_done_callback(lambda done: finished(key, done))
+        else:
+            stats["coalesced"] += 1
+        # shielded: a caller that times out does not cancel the search for the others
+        records = await asyncio.shield(task)
+    if not records:
+        return "no results found"
+    return json.dumps(records, ensure_ascii=False)
+
+
+def search_stats():
+    upstream = stats["upstream"]
+    return dict(
+        stats,
+        cache=search_results.stats(),
+        in_flight=len(in_flight),
+        avg_upstream_ms=stats["upstream_seconds"] / upstream * 1e3 if upstream else 0.0,
+        compact_ratio=stats["compact_chars"] / stats["raw_chars"] if stats["raw_chars"] else 0.0,
+    )
@@ -1,8 +1,7 @@
 # %%
-from sympy import sympify, N
-from sympy.core.sympify import SympifyError
-import re
-import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from ddgs import DDGS
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
@@ -16,6 +15,8 @@ from langgraph.checkpoint.memory import InMemorySaver
 from langgraph.graph.message import add_messages
 from datetime import datetime
 from langchain.prompts import PromptTemplate
+# agent_api deploys on its own, calculator.py is a copy of agent/calculator.py, keep them in step
+from calculator import evaluate
 
 # %%
 def get_current_datetime_response():
@@ -32,34 +33,11 @@ load_dotenv()
 
 # %%
 
-def replace_constants_in_expr(expr: str) -> str:
-    # Replace 'pi' and 'e' only when they appear as standalone tokens or parts of math expressions
-    replacements = {
-        r'\bpi\b': str(math.pi),     # \b ensures 'pi' is a word boundary
-        r'\be\b': str(math.e)
-    }
-    
-    for pattern, value in replacements.items():
-        expr = re.sub(pattern, value, expr)
-    
-    return expr
-
-
 @tool
 def evaluate_expression(expr: str) -> str:
     '''Evaluates any maths expression'''
-    
-    try:
-        expr = replace_constants_in_expr(expr)
-        # Parse the expression symbolically
-        symbolic_expr = sympify(expr)
-        # Evaluate to numeric value with 6 decimal precision
-        result = N(symbolic_expr, 6)
-        return str(result)
-    except SympifyError as e:
-        return f"Invalid expression: {e}"
-    except Exception as e:
-        return f"Error: {e}"
+    # plain arithmetic never touches sympy, symbolic work runs in a limited worker process
+    return evaluate(expr)
 
 
 
@@ -184,18 +162,39 @@ def chat_node(chats: chat):
 tool_dict = {tool.name : tool for tool in tools}
 
 # %%
+# seconds a single tool call may run before its result is dropped
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "20"))
+tool_timeouts = {
+    "evaluate_expression": 5,
+}
+tool_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tool")
+
 def tool_node(chat: chat):
     tool_calls = chat.messages[-1].tool_calls
+    started = time.monotonic()
+    futures = []
     for tool_call in tool_calls:
+        tool = tool_dict.get(tool_call["name"])
+        futures.append(tool_pool.submit(tool.invoke, tool_call["args"]) if tool else None)
+
+    # all calls were submitted together, so each deadline counts from the same
+    # start and a slow tool only costs its own timeout, not the sum of all of them
+    for tool_call, future in zip(tool_calls, futures):
         tool_name = tool_call["name"]
+        timeout = tool_timeouts.get(tool_name, TOOL_TIMEOUT)
         try:
-            tool = tool_dict[tool_name]
-            tool_response = tool.invoke(tool_call["args"])
+            if future is None:
+                raise KeyError(tool_name)
+            tool_response = future.result(timeout=max(0.0, started + timeout - time.monotonic()))
             tool_message = ToolMessage(content=tool_response, name=tool_name, tool_call_id=tool_call["id"])
-            chat.messages.append(tool_message)
+        except FutureTimeoutError:
+            # a running thread cannot be interrupted, cancel only stops calls still queued
+            future.cancel()
+            tool_message = ToolMessage(content=f"{tool_name} did not answer within {timeout} seconds, try again or use another tool",
+                                       name=tool_name, tool_call_id=tool_call["id"])
         except Exception as e:
-            error_message = ToolMessage(content=f"{str(e)}", name = tool_name, tool_call_id=tool_call["id"])
-            chat.messages.append(error_message)
+            tool_message = ToolMessage(content=f"{str(e)}", name = tool_name, tool_call_id=tool_call["id"])
+        chat.messages.append(tool_message)
     return chat
 
 # %%